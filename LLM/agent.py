@@ -1,31 +1,59 @@
 from langgraph.graph import StateGraph, MessagesState, START, END
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.prebuilt import ToolNode
 from langchain_core.messages import RemoveMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from httpx import HTTPStatusError
-import time
-from LLM.llm import llm, llm_with_tools, tools, load_prompt
+from langchain_core.runnables import RunnableLambda
+from LLM.llm import llm, llm_with_tools, llm_without_tools, tools, load_prompt
+from LLM.client import llm_client
+from LLM.checkpoint import load_checkpointer
+from LLM.metrics import metrics
+import os, time, contextlib
 
 prompt_template = ChatPromptTemplate.from_messages(
     [
-        ("system", load_prompt('assistant'),),
+        ("system", load_prompt('assistant') + "{summary}",),
         MessagesPlaceholder(variable_name="messages")
     ])
 
 summary_prompt = load_prompt("dialogue_summary")
+rolling_summary_prompt = load_prompt("rolling_summary")
+summary_llm = llm.with_config(run_name='summary', tags=['summary']) # its tokens are not part of the streamed answer
+
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", 'rolling') # rolling: incremental, after the reply; blocking: every 10 messages, before it
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", 2000)) # history size that triggers a summary
+SUMMARY_KEEP_TURNS = int(os.getenv("SUMMARY_KEEP_TURNS", 2)) # latest turns kept verbatim
+AGENT_MAX_TOOL_ITERATIONS = int(os.getenv("AGENT_MAX_TOOL_ITERATIONS", 4)) # agent steps calling tools per question
+AGENT_DEADLINE = float(os.getenv("AGENT_DEADLINE", 60)) # seconds per question after which no more tools are called
+
+BUDGET_SPENT = ("\n\nThe tools can no longer be used for this question. "
+                "Answer now with the information gathered so far, and say if something could not be looked up.")
+
+class AgentState(MessagesState):
+    summary: str
+    started_at: float # when the question being answered was received
 
 def should_continue(state: MessagesState):
     messages = state["messages"]
     last_message = messages[-1]
     if last_message.tool_calls:
-        return "tools"
+        return "tools" # the calls of one step run concurrently in the tool node
     return END
 
 def trim_messages(state: MessagesState):
     if len(state["messages"]) >= 10 and state["messages"][-1].type == "human":
         last_human_message = state["messages"][-1]
-        summary_message = llm.invoke(state["messages"][:-1] + [HumanMessage(content=summary_prompt)])
+        summary_message = llm_client.invoke(summary_llm, state["messages"][:-1] + [HumanMessage(content=summary_prompt)])
+        delete_messages = [RemoveMessage(id=m.id) for m in state["messages"]]
+        history = [summary_message, last_human_message]
+    else:
+        delete_messages = []
+        history = state["messages"]
+    return history, delete_messages
+
+async def atrim_messages(state: MessagesState):
+    if len(state["messages"]) >= 10 and state["messages"][-1].type == "human":
+        last_human_message = state["messages"][-1]
+        summary_message = await llm_client.ainvoke(summary_llm, state["messages"][:-1] + [HumanMessage(content=summary_prompt)])
         delete_messages = [RemoveMessage(id=m.id) for m in state["messages"]]
         history = [summary_message, last_human_message]
     else:
@@ -34,22 +62,137 @@ def trim_messages(state: MessagesState):
     return history, delete_messages
 
 
-def call_model(state: MessagesState):
-    messages, delete_messages = trim_messages(state)
-    prompt = prompt_template.invoke({"messages": messages})
-    try:
-        response = llm_with_tools.invoke(prompt)
-    except HTTPStatusError:
-        time.sleep(2)
-        response = llm_with_tools.invoke(prompt)
+def count_tokens(messages) -> int:
+    """Rough token count, about four characters per token."""
+
+    return sum(len(str(message.content)) for message in messages) // 4
+
+def split_history(messages):
+    """Split the messages into the ones to fold into the summary and the latest SUMMARY_KEEP_TURNS turns."""
+
+    starts = [i for i, message in enumerate(messages) if message.type == "human"]
+    if len(starts) <= SUMMARY_KEEP_TURNS:
+        return [], messages
+    cut = starts[-SUMMARY_KEEP_TURNS] if SUMMARY_KEEP_TURNS else len(messages)
+    return messages[:cut], messages[cut:]
+
+def summary_request(summary: str, messages) -> str:
+    # tool calls and their results are left out, as in the blocking summary
+    dialogue = "\n".join(f"{'User' if message.type == 'human' else 'Assistant'}: {message.content}" for message in messages
+                         if message.type == "human" or (message.type == "ai" and message.content and not message.tool_calls))
+    return rolling_summary_prompt.format(summary=summary or '(empty)', messages=dialogue)
+
+def messages_to_fold(state: AgentState):
+    """Messages before the latest turns, if the history is over the token budget."""
+
+    if count_tokens(state["messages"]) < SUMMARY_TOKEN_BUDGET:
+        return []
+    return split_history(state["messages"])[0]
+
+@metrics.timed('summary')
+def rolling_summary(state: AgentState):
+    """Fold the old messages into the previous summary. Returns the state update, or None if there is nothing to summarize."""
+
+    old = messages_to_fold(state)
+    if not old:
+        return None
+    summary = llm_client.invoke(summary_llm, summary_request(state.get("summary", ""), old)).content
+    return {"summary": summary, "messages": [RemoveMessage(id=m.id) for m in old]}
+
+@metrics.timed('summary')
+async def arolling_summary(state: AgentState):
+    old = messages_to_fold(state)
+    if not old:
+        return None
+    summary = (await llm_client.ainvoke(summary_llm, summary_request(state.get("summary", ""), old))).content
+    return {"summary": summary, "messages": [RemoveMessage(id=m.id) for m in old]}
+
+def summarize(config):
+    """Update the rolling summary of the thread, called after the reply has been sent."""
+
+    update = rolling_summary(app.get_state(config).values)
+    if update:
+        app.update_state(config, update, as_node="agent")
+
+async def asummarize(config, lock=None):
+    """Update the rolling summary of the thread. The lock of the chat, if given, is held only to read the state
+    and to write the update, not during the model call; the update is dropped if another one was written meanwhile."""
+
+    lock = lock or contextlib.nullcontext()
+    async with lock:
+        state = (await app.aget_state(config)).values
+    update = await arolling_summary(state)
+    if update:
+        async with lock:
+            if (await app.aget_state(config)).values.get("summary", "") != state.get("summary", ""):
+                return
+            await app.aupdate_state(config, update, as_node="agent")
+
+def tool_iterations(messages) -> int:
+    """Agent steps that called tools since the last message of the user."""
+
+    steps = 0
+    for message in reversed(messages):
+        if message.type == "human":
+            break
+        steps += bool(getattr(message, "tool_calls", None))
+    return steps
+
+def tool_budget(state: AgentState):
+    """Start of the current question and the reason why its tool budget is spent, if it is."""
+
+    messages = state["messages"]
+    started_at = time.time() if messages[-1].type == "human" else state.get("started_at") or time.time()
+    if tool_iterations(messages) >= AGENT_MAX_TOOL_ITERATIONS:
+        return started_at, 'iterations'
+    if time.time() - started_at >= AGENT_DEADLINE:
+        return started_at, 'deadline'
+    return started_at, None
+
+def summary_context(state: AgentState) -> str:
+    summary = state.get("summary")
+    return f"\n\nSummary of the earlier conversation:\n{summary}" if summary else ""
+
+def model_for(state: AgentState):
+    """Start of the question, the model and the system prompt context for the next agent step:
+    without tools once the budget of the question is spent, so the loop ends with an answer."""
+
+    started_at, spent = tool_budget(state)
+    if spent:
+        metrics.count('tool_budget_spent', reason=spent)
+        return started_at, llm_without_tools, summary_context(state) + BUDGET_SPENT
+    return started_at, llm_with_tools, summary_context(state)
+
+
+@metrics.timed('agent')
+def call_model(state: AgentState):
+    if SUMMARY_MODE == "rolling":
+        messages, delete_messages = state["messages"], []
+    else:
+        messages, delete_messages = trim_messages(state)
+    started_at, model, context = model_for(state)
+    prompt = prompt_template.invoke({"messages": messages, "summary": context})
+    response = llm_client.invoke(model, prompt)
+    message_updates = messages + [response] + delete_messages
+    return {"messages": message_updates, "started_at": started_at}
+
+@metrics.timed('agent')
+async def acall_model(state: AgentState):
+    if SUMMARY_MODE == "rolling":
+        messages, delete_messages = state["messages"], []
+    else:
+        messages, delete_messages = await atrim_messages(state)
+    started_at, model, context = model_for(state)
+    prompt = prompt_template.invoke({"messages": messages, "summary": context})
+    response = await llm_client.ainvoke(model, prompt)
     message_updates = messages + [response] + delete_messages
-    return {"messages": message_updates}
+    return {"messages": message_updates, "started_at": started_at}
 
-workflow = StateGraph(MessagesState)
+workflow = StateGraph(AgentState)
 tool_node = ToolNode(tools)
-memory = MemorySaver()
+memory = load_checkpointer() # conversations persist across restarts and bot processes
 
-workflow.add_node("agent", call_model)
+workflow.add_node("agent", RunnableLambda(call_model, afunc=acall_model))
 workflow.add_node("tools", tool_node)
 
 workflow.add_edge(START, "agent")
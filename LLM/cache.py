@@ -0,0 +1,199 @@
+import os, re, json, time, hashlib, sqlite3, threading
+from collections import OrderedDict, Counter
+from typing import Optional
+import numpy as np
+
+ANSWER_CACHE_BACKEND = os.getenv('ANSWER_CACHE_BACKEND', 'memory') # memory or sqlite
+ANSWER_CACHE_PATH = os.getenv('ANSWER_CACHE_PATH', 'answer_cache.sqlite')
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', 1024))
+ANSWER_CACHE_TTL = float(os.getenv('ANSWER_CACHE_TTL', 6 * 3600))
+ANSWER_CACHE_SIMILARITY = float(os.getenv('ANSWER_CACHE_SIMILARITY', 0.95))
+ANSWER_CACHE_SEMANTIC = os.getenv('ANSWER_CACHE_SEMANTIC', '1') == '1'
+
+
+def normalize_question(question: str) -> str:
+    question = re.sub(r"[^\w\s:\-']", ' ', question.lower())
+    return re.sub(r'\s+', ' ', question).strip()
+
+def signature(question: str, scope: str = '') -> str:
+    """Dates, times and other numbers of the question, which similar questions must share, with the scope given by
+    the caller, e.g. the cinemas and title named in the question."""
+
+    numbers = ' '.join(sorted(re.findall(r'\d[\d:\-]*', question)))
+    return f'{numbers}|{scope}' if scope else numbers
+
+
+class MemoryBackend():
+    """In-process LRU backend."""
+
+    def __init__(self, max_size=ANSWER_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def candidates(self, namespace, generation, sig):
+        with self.lock:
+            return [entry for entry in self.entries.values()
+                    if entry['namespace'] == namespace and entry['generation'] == generation and entry['signature'] == sig and entry['vector'] is not None]
+
+    def purge(self, namespace, generation):
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry['namespace'] == namespace and entry['generation'] != generation]:
+                del self.entries[key]
+
+
+class SQLiteBackend():
+    """LRU backend in a SQLite file, shared by the bot processes running on the same host."""
+
+    def __init__(self, path=ANSWER_CACHE_PATH, max_size=ANSWER_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        with self.connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute("""CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY, namespace TEXT, generation INTEGER, question TEXT, answer TEXT,
+                vector TEXT, signature TEXT, created_at REAL, used_at REAL)""")
+            connection.execute('CREATE INDEX IF NOT EXISTS answers_lookup ON answers (namespace, generation, signature)')
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    @staticmethod
+    def to_entry(row):
+        namespace, generation, question, answer, vector, sig, created_at = row
+        return {'namespace': namespace, 'generation': generation, 'question': question, 'answer': answer,
+                'vector': json.loads(vector) if vector else None, 'signature': sig, 'created_at': created_at}
+
+    def get(self, key):
+        with self.connect() as connection:
+            row = connection.execute("""SELECT namespace, generation, question, answer, vector, signature, created_at
+                FROM answers WHERE key = ?""", (key,)).fetchone()
+            if row:
+                connection.execute('UPDATE answers SET used_at = ? WHERE key = ?', (time.time(), key))
+        return self.to_entry(row) if row else None
+
+    def set(self, key, entry):
+        vector = json.dumps(entry['vector']) if entry['vector'] is not None else None
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, entry['namespace'], entry['generation'], entry['question'], entry['answer'],
+                 vector, entry['signature'], entry['created_at'], time.time()))
+            connection.execute("""DELETE FROM answers WHERE key IN (
+                SELECT key FROM answers ORDER BY used_at DESC LIMIT -1 OFFSET ?)""", (self.max_size,))
+
+    def delete(self, key):
+        with self.connect() as connection:
+            connection.execute('DELETE FROM answers WHERE key = ?', (key,))
+
+    def candidates(self, namespace, generation, sig):
+        with self.connect() as connection:
+            rows = connection.execute("""SELECT namespace, generation, question, answer, vector, signature, created_at
+                FROM answers WHERE namespace = ? AND generation = ? AND signature = ? AND vector IS NOT NULL""",
+                (namespace, generation, sig)).fetchall()
+        return [self.to_entry(row) for row in rows]
+
+    def purge(self, namespace, generation):
+        with self.connect() as connection:
+            connection.execute('DELETE FROM answers WHERE namespace = ? AND generation IS NOT ?', (namespace, generation))
+
+
+BACKENDS = {'memory': MemoryBackend, 'sqlite': SQLiteBackend}
+
+
+class AnswerCache():
+    """Cache of tool results keyed on the normalized, date-resolved question.
+    Entries belong to a generation of the data of their namespace, e.g. the timetable, so a reload invalidates them."""
+
+    def __init__(self, backend=None, ttl=ANSWER_CACHE_TTL, similarity=ANSWER_CACHE_SIMILARITY):
+        self.backend = backend or BACKENDS[ANSWER_CACHE_BACKEND]()
+        self.ttl = ttl
+        self.similarity = similarity
+        self.generations = {} # namespace -> generation of its entries
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(namespace, question, generation):
+        return hashlib.sha1(f'{namespace}|{generation}|{question}'.encode('utf-8')).hexdigest()
+
+    def check_generation(self, namespace, generation):
+        """Drop the entries of previous generations of the namespace."""
+
+        with self.lock:
+            if namespace in self.generations and generation == self.generations[namespace]:
+                return
+            self.generations[namespace] = generation
+        self.backend.purge(namespace, generation)
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def expired(self, entry):
+        return time.time() - entry['created_at'] > self.ttl
+
+    def get(self, namespace: str, question: str, generation: int) -> Optional[str]:
+        """Exact match lookup."""
+
+        self.check_generation(namespace, generation)
+        key = self.key(namespace, normalize_question(question), generation)
+        entry = self.backend.get(key)
+        if entry and self.expired(entry):
+            self.backend.delete(key)
+            entry = None
+        self.count('exact_hits' if entry else 'exact_misses')
+        return entry['answer'] if entry else None
+
+    def get_similar(self, namespace: str, question: str, generation: int, vector, scope: str = '') -> Optional[str]:
+        """Embedding similarity lookup among the questions with the same dates, numbers and scope."""
+
+        if not ANSWER_CACHE_SEMANTIC or vector is None:
+            return None
+        candidates = [entry for entry in self.backend.candidates(namespace, generation, signature(normalize_question(question), scope))
+                      if not self.expired(entry) and len(entry['vector']) == len(vector)] # skip vectors of another embedding model
+        answer = None
+        if candidates:
+            matrix = np.array([entry['vector'] for entry in candidates], dtype=np.float32)
+            query = np.asarray(vector, dtype=np.float32)
+            scores = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-9)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.similarity:
+                answer = candidates[best]['answer']
+        self.count('semantic_hits' if answer else 'semantic_misses')
+        return answer
+
+    def set(self, namespace: str, question: str, generation: int, answer: str, vector=None, scope: str = ''):
+        question = normalize_question(question)
+        entry = {'namespace': namespace, 'generation': generation, 'question': question, 'answer': answer,
+                 'vector': list(map(float, vector)) if vector is not None else None,
+                 'signature': signature(question, scope), 'created_at': time.time()}
+        self.backend.set(self.key(namespace, question, generation), entry)
+        self.count('stores')
+
+    def metrics(self) -> dict:
+        """Hit counters and the overall hit rate of the lookups."""
+
+        with self.lock:
+            stats = dict(self.stats)
+        hits = stats.get('exact_hits', 0) + stats.get('semantic_hits', 0)
+        lookups = stats.get('exact_hits', 0) + stats.get('exact_misses', 0)
+        stats['hit_rate'] = hits / lookups if lookups else 0.0
+        return stats
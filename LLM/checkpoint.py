@@ -0,0 +1,244 @@
+import os, time, asyncio, threading
+from typing import Any, Iterator, Optional, Sequence
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import BaseCheckpointSaver, ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple, WRITES_IDX_MAP
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.constants import TASKS
+from sqlalchemy import event, Table, MetaData, Column, Integer, Float, String, LargeBinary, Index, select, delete, insert, update
+from sqlalchemy.dialects import mysql
+from database.engine import get_engine, get_async_engine
+
+CHECKPOINT_URL = os.getenv("CHECKPOINT_URL", 'sqlite:///checkpoints.sqlite') # any SQLAlchemy URL, or memory
+CHECKPOINT_TTL = float(os.getenv("CHECKPOINT_TTL", 7 * 24 * 3600)) # seconds a conversation is kept after its last message
+CHECKPOINT_MAX_PER_THREAD = max(2, int(os.getenv("CHECKPOINT_MAX_PER_THREAD", 10)))
+CHECKPOINT_EVICT_INTERVAL = float(os.getenv("CHECKPOINT_EVICT_INTERVAL", 600)) # seconds between sweeps of expired threads
+
+Blob = LargeBinary().with_variant(mysql.LONGBLOB(), 'mysql') # BLOB is limited to 64 KB in MySQL
+
+metadata = MetaData()
+threads_table = Table('checkpoint_threads', metadata,
+    Column('thread_id', String(255), primary_key=True),
+    Column('updated_at', Float, nullable=False),
+    Index('ix_checkpoint_threads_updated_at', 'updated_at'))
+checkpoints_table = Table('checkpoints', metadata,
+    Column('thread_id', String(255), primary_key=True),
+    Column('checkpoint_ns', String(255), primary_key=True),
+    Column('checkpoint_id', String(64), primary_key=True), # uuid6, ordered by time
+    Column('parent_checkpoint_id', String(64)),
+    Column('type', String(32)),
+    Column('checkpoint', Blob, nullable=False),
+    Column('metadata_type', String(32)),
+    Column('metadata', Blob, nullable=False))
+writes_table = Table('checkpoint_writes', metadata,
+    Column('thread_id', String(255), primary_key=True),
+    Column('checkpoint_ns', String(255), primary_key=True),
+    Column('checkpoint_id', String(64), primary_key=True),
+    Column('task_id', String(64), primary_key=True),
+    Column('idx', Integer, primary_key=True, autoincrement=False),
+    Column('channel', String(255), nullable=False),
+    Column('type', String(32)),
+    Column('value', Blob))
+
+
+class SQLCheckpointSaver(BaseCheckpointSaver):
+    """LangGraph checkpointer persisted through SQLAlchemy, so it works the same on SQLite, MySQL and Postgres
+    and can be shared by several bot processes. Only the last CHECKPOINT_MAX_PER_THREAD checkpoints of a thread
+    are kept, and threads without messages for CHECKPOINT_TTL seconds are deleted.
+    With DB_ASYNC the async methods use an asyncio driver instead of worker threads."""
+
+    def __init__(self, url=CHECKPOINT_URL, ttl=CHECKPOINT_TTL, max_per_thread=CHECKPOINT_MAX_PER_THREAD,
+                 evict_interval=CHECKPOINT_EVICT_INTERVAL, *, serde=None):
+        super().__init__(serde=serde)
+        self.engine = get_engine(url=url)
+        self.async_engine = get_async_engine(url=url)
+        if self.engine.dialect.name == 'sqlite':
+            for engine in filter(None, (self.engine, self.async_engine and self.async_engine.sync_engine)):
+                event.listen(engine, 'connect', self.set_wal)
+        metadata.create_all(self.engine)
+        self.ttl = ttl
+        self.max_per_thread = max_per_thread
+        self.evict_interval = evict_interval
+        self.evicted_at = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def set_wal(connection, _):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.close()
+
+    @staticmethod
+    def keys(config: RunnableConfig):
+        configurable = config['configurable']
+        return str(configurable['thread_id']), configurable.get('checkpoint_ns', ''), configurable.get('checkpoint_id')
+
+    def load_tuple(self, connection, row) -> CheckpointTuple:
+        thread_id, checkpoint_ns, checkpoint_id = row.thread_id, row.checkpoint_ns, row.checkpoint_id
+        writes = connection.execute(select(writes_table.c.task_id, writes_table.c.channel, writes_table.c.type, writes_table.c.value)
+            .where(writes_table.c.thread_id == thread_id, writes_table.c.checkpoint_ns == checkpoint_ns,
+                   writes_table.c.checkpoint_id == checkpoint_id)
+            .order_by(writes_table.c.task_id, writes_table.c.idx)).all()
+        sends = []
+        if row.parent_checkpoint_id:
+            sends = connection.execute(select(writes_table.c.type, writes_table.c.value)
+                .where(writes_table.c.thread_id == thread_id, writes_table.c.checkpoint_ns == checkpoint_ns,
+                       writes_table.c.checkpoint_id == row.parent_checkpoint_id, writes_table.c.channel == TASKS)
+                .order_by(writes_table.c.task_id, writes_table.c.idx)).all()
+        checkpoint = self.serde.loads_typed((row.type, row.checkpoint))
+        return CheckpointTuple(
+            config={'configurable': {'thread_id': thread_id, 'checkpoint_ns': checkpoint_ns, 'checkpoint_id': checkpoint_id}},
+            checkpoint={**checkpoint, 'pending_sends': [self.serde.loads_typed((send.type, send.value)) for send in sends]},
+            metadata=self.serde.loads_typed((row.metadata_type, row.metadata)),
+            parent_config={'configurable': {'thread_id': thread_id, 'checkpoint_ns': checkpoint_ns,
+                                            'checkpoint_id': row.parent_checkpoint_id}} if row.parent_checkpoint_id else None,
+            pending_writes=[(write.task_id, write.channel, self.serde.loads_typed((write.type, write.value))) for write in writes])
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        with self.engine.connect() as connection:
+            return self.read_tuple(connection, config)
+
+    def read_tuple(self, connection, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id, checkpoint_ns, checkpoint_id = self.keys(config)
+        query = select(checkpoints_table).where(checkpoints_table.c.thread_id == thread_id, checkpoints_table.c.checkpoint_ns == checkpoint_ns)
+        if checkpoint_id:
+            query = query.where(checkpoints_table.c.checkpoint_id == checkpoint_id)
+        row = connection.execute(query.order_by(checkpoints_table.c.checkpoint_id.desc()).limit(1)).first()
+        return self.load_tuple(connection, row) if row else None
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        query = select(checkpoints_table)
+        if config:
+            thread_id, checkpoint_ns, checkpoint_id = self.keys(config)
+            query = query.where(checkpoints_table.c.thread_id == thread_id)
+            if 'checkpoint_ns' in config['configurable']:
+                query = query.where(checkpoints_table.c.checkpoint_ns == checkpoint_ns)
+            if checkpoint_id:
+                query = query.where(checkpoints_table.c.checkpoint_id == checkpoint_id)
+        if before:
+            query = query.where(checkpoints_table.c.checkpoint_id < self.keys(before)[2])
+        with self.engine.connect() as connection:
+            rows = connection.execute(query.order_by(checkpoints_table.c.checkpoint_id.desc())).all()
+            for row in rows:
+                if limit is not None and limit <= 0:
+                    break
+                item = self.load_tuple(connection, row)
+                if filter and not all(item.metadata.get(key) == value for key, value in filter.items()):
+                    continue # metadata is serialized, so it is filtered here rather than in SQL
+                if limit is not None:
+                    limit -= 1
+                yield item
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        with self.engine.begin() as connection:
+            stored = self.write_checkpoint(connection, config, checkpoint, metadata)
+        self.evict()
+        return stored
+
+    def write_checkpoint(self, connection, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata) -> RunnableConfig:
+        thread_id, checkpoint_ns, parent_checkpoint_id = self.keys(config)
+        type_, serialized = self.serde.dumps_typed(checkpoint)
+        metadata_type, serialized_metadata = self.serde.dumps_typed(metadata)
+        connection.execute(delete(checkpoints_table).where(checkpoints_table.c.thread_id == thread_id,
+            checkpoints_table.c.checkpoint_ns == checkpoint_ns, checkpoints_table.c.checkpoint_id == checkpoint['id']))
+        connection.execute(insert(checkpoints_table).values(thread_id=thread_id, checkpoint_ns=checkpoint_ns,
+            checkpoint_id=checkpoint['id'], parent_checkpoint_id=parent_checkpoint_id, type=type_, checkpoint=serialized,
+            metadata_type=metadata_type, metadata=serialized_metadata))
+        self.touch(connection, thread_id)
+        self.prune(connection, thread_id, checkpoint_ns)
+        return {'configurable': {'thread_id': thread_id, 'checkpoint_ns': checkpoint_ns, 'checkpoint_id': checkpoint['id']}}
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str, task_path: str = '') -> None:
+        with self.engine.begin() as connection:
+            self.write_writes(connection, config, writes, task_id)
+
+    def write_writes(self, connection, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str):
+        thread_id, checkpoint_ns, checkpoint_id = self.keys(config)
+        replace = all(channel in WRITES_IDX_MAP for channel, _ in writes) # special writes overwrite, others are kept once
+        for idx, (channel, value) in enumerate(writes):
+            key = dict(thread_id=thread_id, checkpoint_ns=checkpoint_ns, checkpoint_id=checkpoint_id,
+                       task_id=task_id, idx=WRITES_IDX_MAP.get(channel, idx))
+            where = [writes_table.c[name] == key_value for name, key_value in key.items()]
+            exists = connection.execute(select(writes_table.c.idx).where(*where)).first()
+            type_, serialized = self.serde.dumps_typed(value)
+            if not exists:
+                connection.execute(insert(writes_table).values(**key, channel=channel, type=type_, value=serialized))
+            elif replace:
+                connection.execute(update(writes_table).where(*where).values(channel=channel, type=type_, value=serialized))
+
+    def touch(self, connection, thread_id: str):
+        now = time.time()
+        if not connection.execute(update(threads_table).where(threads_table.c.thread_id == thread_id).values(updated_at=now)).rowcount:
+            connection.execute(insert(threads_table).values(thread_id=thread_id, updated_at=now))
+
+    def prune(self, connection, thread_id: str, checkpoint_ns: str):
+        """Delete the checkpoints of the thread beyond the newest max_per_thread, with their writes."""
+
+        old = connection.execute(select(checkpoints_table.c.checkpoint_id)
+            .where(checkpoints_table.c.thread_id == thread_id, checkpoints_table.c.checkpoint_ns == checkpoint_ns)
+            .order_by(checkpoints_table.c.checkpoint_id.desc()).offset(self.max_per_thread)).scalars().all()
+        if old:
+            for table in (checkpoints_table, writes_table):
+                connection.execute(delete(table).where(table.c.thread_id == thread_id, table.c.checkpoint_ns == checkpoint_ns,
+                                                       table.c.checkpoint_id.in_(old)))
+
+    def evict(self):
+        """Delete the threads idle for longer than the TTL, at most once per evict_interval."""
+
+        with self.lock:
+            if time.monotonic() - self.evicted_at < self.evict_interval:
+                return
+            self.evicted_at = time.monotonic()
+        with self.engine.begin() as connection:
+            expired = connection.execute(select(threads_table.c.thread_id)
+                .where(threads_table.c.updated_at < time.time() - self.ttl)).scalars().all()
+            for i in range(0, len(expired), 500):
+                self.delete_threads(connection, expired[i:i+500])
+
+    def delete_threads(self, connection, thread_ids: Sequence[str]):
+        for table in (writes_table, checkpoints_table, threads_table):
+            connection.execute(delete(table).where(table.c.thread_id.in_(thread_ids)))
+
+    def delete_thread(self, thread_id) -> None:
+        """Forget a conversation."""
+
+        with self.engine.begin() as connection:
+            self.delete_threads(connection, [str(thread_id)])
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        if not self.async_engine:
+            return await asyncio.to_thread(self.get_tuple, config)
+        async with self.async_engine.connect() as connection:
+            return await connection.run_sync(self.read_tuple, config)
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None, limit: Optional[int] = None):
+        items = await asyncio.to_thread(lambda: [*self.list(config, filter=filter, before=before, limit=limit)])
+        for item in items:
+            yield item
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        if not self.async_engine:
+            return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+        async with self.async_engine.begin() as connection:
+            stored = await connection.run_sync(self.write_checkpoint, config, checkpoint, metadata)
+        if time.monotonic() - self.evicted_at >= self.evict_interval:
+            await asyncio.to_thread(self.evict)
+        return stored
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str, task_path: str = '') -> None:
+        if not self.async_engine:
+            return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+        async with self.async_engine.begin() as connection:
+            await connection.run_sync(self.write_writes, config, writes, task_id)
+
+    async def adelete_thread(self, thread_id) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+
+def load_checkpointer(url=CHECKPOINT_URL) -> BaseCheckpointSaver:
+    """Checkpointer of the conversations: in process memory for `memory`, otherwise in the SQL database at the URL."""
+
+    return MemorySaver() if url == 'memory' else SQLCheckpointSaver(url)
@@ -0,0 +1,132 @@
+import os, time, random, asyncio, logging, threading
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Optional
+from httpx import HTTPStatusError, TransportError
+from LLM.metrics import metrics, current_stage
+
+LLM_RATE_LIMIT = float(os.getenv("LLM_RATE_LIMIT", 1)) # requests per second to the Mistral API
+LLM_BURST = int(os.getenv("LLM_BURST", 2))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 4)) # requests in flight, across threads and coroutines
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 5))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", 1)) # seconds
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", 30))
+
+RETRY_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class TokenBucket():
+    """Token bucket refilled at `rate` tokens per second, holding at most `burst` tokens.
+    A token is reserved at once and the caller waits for it, so waiting callers are served in order."""
+
+    def __init__(self, rate=LLM_RATE_LIMIT, burst=LLM_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token and return the seconds to wait before using it."""
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds requested by the Retry-After header of the response, if any."""
+
+    response = getattr(error, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, HTTPStatusError):
+        return error.response.status_code in RETRY_STATUSES
+    return isinstance(error, TransportError)
+
+
+class LLMClient():
+    """Shared gate for the calls to the Mistral API: a token bucket for the request rate, a cap on concurrent requests
+    and retries with exponential backoff and full jitter that honour Retry-After.
+    Sync calls wait with time.sleep (they run in worker threads), async calls with asyncio.sleep."""
+
+    def __init__(self, rate=LLM_RATE_LIMIT, burst=LLM_BURST, concurrency=LLM_MAX_CONCURRENCY,
+                 retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX):
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = threading.BoundedSemaphore(concurrency) # shared by threads and event loops
+        self.waiters = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='llm-slot') # async callers wait here
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        requested = retry_after(error)
+        return max(delay, min(requested, self.backoff_max)) if requested is not None else delay
+
+    def call(self, func, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            time.sleep(self.bucket.reserve())
+            with self.slots:
+                try:
+                    return func(*args, **kwargs)
+                except (HTTPStatusError, TransportError) as e:
+                    if attempt == self.retries or not is_retryable(e):
+                        raise
+                    delay = self.backoff(attempt, e)
+                    logging.warning(f'{type(e).__name__} in {getattr(func, "__qualname__", func)}, retrying in {delay:.1f}s')
+                    metrics.count('llm_retries', stage=current_stage.get())
+            time.sleep(delay)
+
+    async def acquire(self):
+        """Take a slot without blocking the event loop: at once if one is free, else waiting in a thread of the client,
+        so the default executor running the tools and the checkpointer is not taken up by waiting callers."""
+
+        if self.slots.acquire(blocking=False):
+            return
+        waiter = asyncio.get_running_loop().run_in_executor(self.waiters, self.slots.acquire)
+        try:
+            await asyncio.shield(waiter)
+        except asyncio.CancelledError: # the thread still gets the slot, give it back then
+            waiter.add_done_callback(lambda _: self.slots.release())
+            raise
+
+    async def acall(self, func, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            await asyncio.sleep(self.bucket.reserve())
+            await self.acquire()
+            try:
+                return await func(*args, **kwargs)
+            except (HTTPStatusError, TransportError) as e:
+                if attempt == self.retries or not is_retryable(e):
+                    raise
+                delay = self.backoff(attempt, e)
+                logging.warning(f'{type(e).__name__} in {getattr(func, "__qualname__", func)}, retrying in {delay:.1f}s')
+                metrics.count('llm_retries', stage=current_stage.get())
+            finally:
+                self.slots.release()
+            await asyncio.sleep(delay)
+
+    def invoke(self, runnable, input, **kwargs):
+        return self.call(runnable.invoke, input, **kwargs)
+
+    async def ainvoke(self, runnable, input, **kwargs):
+        return await self.acall(runnable.ainvoke, input, **kwargs)
+
+
+llm_client = LLMClient()
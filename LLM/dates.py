@@ -0,0 +1,184 @@
+import re
+from datetime import datetime, date, timedelta
+from typing import Optional
+
+# Parts of the day, same ranges as in prompts/relative_dates.txt
+DAY_PARTS = {
+    'morning': ('06:00', '12:00'), 'mattina': ('06:00', '12:00'), 'mattinata': ('06:00', '12:00'), 'mattino': ('06:00', '12:00'),
+    'afternoon': ('12:00', '18:00'), 'pomeriggio': ('12:00', '18:00'),
+    'evening': ('18:00', '22:00'), 'sera': ('18:00', '22:00'), 'serata': ('18:00', '22:00'),
+    'night': ('22:00', '23:59'), 'notte': ('22:00', '23:59'),
+    }
+
+MEALS = {
+    'after lunch': ('14:00', '18:00'), 'dopo pranzo': ('14:00', '18:00'),
+    'before dinner': ('14:00', '18:00'), 'prima di cena': ('14:00', '18:00'),
+    'at lunchtime': ('12:00', '15:00'), 'a pranzo': ('12:00', '15:00'), 'all\'ora di pranzo': ('12:00', '15:00'),
+    'after dinner': ('21:00', '23:59'), 'dopo cena': ('21:00', '23:59'),
+    }
+
+WEEKDAYS = {
+    'monday': 0, 'tuesday': 1, 'wednesday': 2, 'thursday': 3, 'friday': 4, 'saturday': 5, 'sunday': 6,
+    'lunedì': 0, 'martedì': 1, 'mercoledì': 2, 'giovedì': 3, 'venerdì': 4, 'sabato': 5, 'domenica': 6,
+    }
+
+NUMBERS = {
+    'a': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7,
+    'un': 1, 'uno': 1, 'una': 1, 'due': 2, 'tre': 3, 'quattro': 4, 'cinque': 5, 'sei': 6, 'sette': 7,
+    }
+
+PART = r"(?:\s+(?:in the |at |di |in |nel |nella |alla )?(?P<part>morning|afternoon|evening|night|mattinata|mattina|mattino|pomeriggio|serata|sera|notte))?"
+WEEKDAY = r"(?P<weekday>monday|tuesday|wednesday|thursday|friday|saturday|sunday|luned[iìí]|marted[iìí]|mercoled[iìí]|gioved[iìí]|venerd[iìí]|sabato|domenica)"
+NUMBER = r"(?P<n>\d{1,2}|" + "|".join(NUMBERS) + r")"
+
+# Anything still looking like a relative expression after the rules ran
+RESIDUAL_CUES = re.compile(
+    r"\b(today|tomorrow|yesterday|tonight|next|last|weekends?|weeks?|months?|years?|days?|later|ago|"
+    r"oggi|domani|dopodomani|ieri|stasera|stanotte|prossim[oaie]|scors[oaie]|settiman[ae]|mes[ei]|giorn[oi]|anno)\b",
+    re.IGNORECASE)
+
+
+def _weekday_index(name):
+    name = name.lower().replace('í', 'ì')
+    if name.endswith('di'):
+        name = name[:-1] + 'ì'
+    return WEEKDAYS[name]
+
+def _format_range(day: date, start: str, end: str, now: datetime, italian: bool) -> str:
+    """Format a date with a time range, ignoring the part of today that already passed."""
+
+    if day == now.date() and now.strftime('%H:%M') > start and now.strftime('%H:%M') < end:
+        start = now.strftime('%H:%M')
+    if italian:
+        return f"{day.isoformat()} dalle {start} alle {end}"
+    return f"{day.isoformat()} from {start} to {end}"
+
+def _format_day(day: date, part: Optional[str], now: datetime, italian: bool) -> str:
+    if part:
+        start, end = DAY_PARTS[part.lower()]
+        return _format_range(day, start, end, now, italian)
+    return day.isoformat()
+
+def _format_span(first: date, last: date, italian: bool) -> str:
+    if first == last:
+        return first.isoformat()
+    if italian:
+        return f"dal {first.isoformat()} al {last.isoformat()}"
+    return f"from {first.isoformat()} to {last.isoformat()}"
+
+def _weekend(today: date, following: bool = False) -> tuple[date, date]:
+    saturday = today + timedelta(days=(5 - today.weekday()) % 7)
+    if today.weekday() == 6:
+        saturday = today - timedelta(days=1)
+    if following and today.weekday() >= 5:
+        saturday += timedelta(days=7)
+    return max(saturday, today), saturday + timedelta(days=1)
+
+
+def _rules():
+    """Return (pattern, language, handler) triples, most specific first."""
+
+    def offset(days):
+        return lambda m, now, it: _format_day(now.date() + timedelta(days=days), m.group('part'), now, it)
+
+    def in_days(multiplier):
+        def handler(m, now, it):
+            n = m.group('n').lower()
+            n = int(n) if n.isdigit() else NUMBERS[n]
+            return _format_day(now.date() + timedelta(days=n * multiplier), m.groupdict().get('part'), now, it)
+        return handler
+
+    def weekday(strictly_after):
+        def handler(m, now, it):
+            delta = (_weekday_index(m.group('weekday')) - now.weekday()) % 7
+            if strictly_after and delta == 0:
+                delta = 7
+            return _format_day(now.date() + timedelta(days=delta), m.group('part'), now, it)
+        return handler
+
+    def weekend(following):
+        return lambda m, now, it: _format_span(*_weekend(now.date(), following), it)
+
+    def this_week(m, now, it):
+        today = now.date()
+        return _format_span(today, today + timedelta(days=6 - today.weekday()), it)
+
+    def next_week(m, now, it):
+        monday = now.date() + timedelta(days=7 - now.weekday())
+        return _format_span(monday, monday + timedelta(days=6), it)
+
+    def part_of_today(part):
+        def handler(m, now, it):
+            start, end = DAY_PARTS[part]
+            return _format_range(now.date(), start, end, now, it)
+        return handler
+
+    def tonight(m, now, it):
+        return _format_range(now.date(), '18:00', '23:59', now, it)
+
+    def right_now(m, now, it):
+        if it:
+            return f"{now.date().isoformat()} dopo le {now.strftime('%H:%M')}"
+        return f"{now.date().isoformat()} after {now.strftime('%H:%M')}"
+
+    def meal(m, now, it):
+        start, end = MEALS[m.group(0).lower()]
+        return f"dalle {start} alle {end}" if it else f"from {start} to {end}"
+
+    return [
+        (r"(?:the )?day after tomorrow" + PART, False, offset(2)),
+        (r"dopodomani" + PART, True, offset(2)),
+        (r"tomorrow" + PART, False, offset(1)),
+        (r"domani" + PART, True, offset(1)),
+        (r"yesterday" + PART, False, offset(-1)),
+        (r"ieri" + PART, True, offset(-1)),
+        (r"tonight", False, tonight),
+        (r"stasera|stanotte", True, tonight),
+        (r"this (?P<p>morning|afternoon|evening)", False, lambda m, now, it: part_of_today(m.group('p').lower())(m, now, it)),
+        (r"stamattina|stamani", True, part_of_today('mattina')),
+        (r"(?:questo|oggi) pomeriggio", True, part_of_today('pomeriggio')),
+        (r"(?:questa|oggi) sera", True, part_of_today('sera')),
+        (r"today" + PART, False, offset(0)),
+        (r"oggi" + PART, True, offset(0)),
+        (r"(?:in|within) " + NUMBER + r" days?" + PART, False, in_days(1)),
+        (NUMBER + r" days? from now" + PART, False, in_days(1)),
+        (r"(?:tra|fra) " + NUMBER + r" giorn[oi]" + PART, True, in_days(1)),
+        (r"in " + NUMBER + r" weeks?", False, in_days(7)),
+        (r"(?:tra|fra) " + NUMBER + r" settiman[ae]", True, in_days(7)),
+        (r"right now|now", False, right_now),
+        (r"adesso|in questo momento", True, right_now),
+        (r"next weekend", False, weekend(True)),
+        (r"(?:il |nel )?(?:prossimo (?:weekend|fine settimana)|(?:weekend|fine settimana) prossimo)", True, weekend(True)),
+        (r"(?:questo|il|nel|per il) (?:weekend|fine settimana)|fine settimana", True, weekend(False)),
+        (r"(?:(?:this|the|on the|at the|over the) )?weekend", False, weekend(False)),
+        (r"next week", False, next_week),
+        (r"(?:la |nella )?(?:prossima settimana|settimana prossima)", True, next_week),
+        (r"this week", False, this_week),
+        (r"(?:in )?questa settimana", True, this_week),
+        (r"(?:next|prossimo|prossima) " + WEEKDAY + PART, None, weekday(True)),
+        (WEEKDAY + r" prossim[oa]" + PART, None, weekday(True)),
+        (r"(?:(?:this|on|questo|questa) )?" + WEEKDAY + PART, None, weekday(False)),
+        (r"after lunch|before dinner|at lunchtime|after dinner", False, meal),
+        (r"dopo pranzo|prima di cena|a pranzo|all'ora di pranzo|dopo cena", True, meal),
+        ]
+
+RULES = [(re.compile(r"\b(?:" + pattern + r")\b", re.IGNORECASE), italian, handler) for pattern, italian, handler in _rules()]
+ENGLISH_WEEKDAYS = set(list(WEEKDAYS)[:7])
+
+
+def resolve_dates(text: str, now: Optional[datetime] = None) -> Optional[str]:
+    """Rewrite relative Italian and English date and time expressions with absolute dates and times.
+    Returns None if the text still contains a relative expression no rule understands."""
+
+    now = now or datetime.now()
+    for pattern, italian, handler in RULES:
+        def substitute(m):
+            is_italian = italian
+            if is_italian is None: # weekday rules serve both languages
+                is_italian = m.group('weekday').lower() not in ENGLISH_WEEKDAYS
+            return handler(m, now, is_italian)
+        text = pattern.sub(substitute, text)
+
+    if RESIDUAL_CUES.search(text):
+        return None
+    return text
@@ -1,27 +1,41 @@
 from typing_extensions import TypedDict
 from typing import Optional
 from pydantic import BaseModel, Field
-from langchain_mistralai import ChatMistralAI, MistralAIEmbeddings
+from langchain_mistralai import ChatMistralAI
 from langchain_core.tools import tool
-from langchain_community.tools.sql_database.tool import QuerySQLDatabaseTool
 from langchain_community.utilities.sql_database import SQLDatabase
-from langchain_chroma import Chroma
-from httpx import HTTPStatusError
-import time, os
+from httpx import HTTPStatusError, TransportError
+from sqlalchemy.exc import SQLAlchemyError
+import os, logging
 from datetime import datetime
 from database.extract import get_db_engine
+from database.snapshot import TimetableSnapshot, TIMETABLE_SNAPSHOT
+from database.vectorstore import embeddings, vectordb, get_version
+from LLM.dates import resolve_dates
+from LLM.schema import TableInfoCache
+from LLM.templates import match_intent, match_entities, query_intent, snapshot_intent
+from LLM.cache import AnswerCache, ANSWER_CACHE_SEMANTIC
+from LLM.retrieval import HybridRetriever
+from LLM.client import llm_client
+from LLM.metrics import metrics, TokenCallback
+from LLM.sql_guard import SQLGuard, UnsafeQuery
 
 
 MISTRALAI_API_KEY = os.getenv("MISTRALAI_API_KEY")
+DB_TABLE = os.getenv("DB_TABLE")
 
-embeddings = MistralAIEmbeddings(api_key=MISTRALAI_API_KEY)
-llm = ChatMistralAI(model="mistral-large-latest", temperature=0, api_key=MISTRALAI_API_KEY)
+llm = ChatMistralAI(model="mistral-large-latest", temperature=0, api_key=MISTRALAI_API_KEY, callbacks=[TokenCallback()])
 
-engine = get_db_engine() # SQL database
-db = SQLDatabase(engine)
+engine = get_db_engine(readonly=True) # SQL database, the replica if one is configured
+db = SQLDatabase(engine, include_tables=[DB_TABLE], sample_rows_in_table_info=0, view_support=True) # the timetable may be a view over the normalized tables
+table_info_cache = TableInfoCache(db, engine)
+sql_guard = SQLGuard(engine, tables=[DB_TABLE])
+timetable_snapshot = TimetableSnapshot(engine)
+answer_cache = AnswerCache()
+hybrid_retriever = HybridRetriever(vectordb, version=get_version)
+metrics.add_collector('answer_cache', answer_cache.metrics)
+metrics.add_collector('embedding_cache', lambda: dict(embeddings.stats))
 
-persist_directory = 'database/chroma/' # Chroma vector store
-vectordb = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
 
 def load_prompt(filename):
     with open(f"LLM/prompts/{filename}.txt", "r") as f:
@@ -42,19 +56,27 @@ class QueryOutput(BaseModel):
     query: str = Field(description="Syntactically valid SQL query.")
 
 @tool
+@metrics.timed()
 def date_tool(state: State) -> str:
-    """Rewrites user input resolving all relative date and time expressions."""
+    """Rewrites user input resolving all relative date and time expressions.
+    Not needed before find_showtimes, which resolves the dates itself."""
     
-    today = datetime.now()
-    today_date = today.strftime("%Y-%m-%d")
-    today_time = today.strftime("%H:%M")
-    day_of_week = today.strftime("%A")
-    input = state['question']
-    updated_query = resolve_relative_date(input, today_date, today_time, day_of_week).content
+    return {'question': resolve_question(state['question'])}
 
-    return {'question': updated_query}
+def resolve_question(input: str) -> str:
+    """The question with absolute dates and times in place of the relative ones."""
+
+    today = datetime.now()
+    updated_query = resolve_dates(input, today) # rule-based, the LLM is used only for expressions it doesn't know
+    if updated_query is None:
+        today_date = today.strftime("%Y-%m-%d")
+        today_time = today.strftime("%H:%M")
+        day_of_week = today.strftime("%A")
+        updated_query = resolve_relative_date(input, today_date, today_time, day_of_week).content
+    return updated_query
 
 @tool
+@metrics.timed()
 def retrieve_movie_info(state: State) -> str:
     """Retrieve information about movies stored in the database. 
     Use this tool whenever a user asks about specific movies, movies of a certain genre, release dates, durations, ratings, cast, directors, or general movie-related queries. 
@@ -62,62 +84,129 @@ def retrieve_movie_info(state: State) -> str:
     This tool provides accurate information from the vector database rather than relying on general knowledge."""
 	
     input = state['question']
-    try:
-        docs = vectordb.similarity_search(input,k=3)
-    except HTTPStatusError:
-        time.sleep(2)
-        docs = vectordb.similarity_search(input,k=3)
-
-    serialized = "\n\n".join(
-        (f"Source: {doc.metadata}\n" f"Content: {doc.page_content}")
-        for doc in docs)    
+    question, generation = cache_question(input), get_version() # the movie documents, not the timetable
+    cached = answer_cache.get('movie_info', question, generation)
+    if cached is not None:
+        return {'result': cached}
+
+    with metrics.stage('metadata_search'):
+        docs = hybrid_retriever.structured(input) # titles, people and genres are matched without embeddings
+    if docs is not None:
+        serialized = serialize_docs(docs)
+        answer_cache.set('movie_info', question, generation, serialized)
+        return {'result': serialized}
+
+    with metrics.stage('embed_query'):
+        vector = embeddings.embed_query(input) # retried by the client on rate limits
+    cached = answer_cache.get_similar('movie_info', question, generation, vector)
+    if cached is not None:
+        return {'result': cached}
+
+    with metrics.stage('vector_search'):
+        docs = hybrid_retriever.hybrid(input, vector)
+    serialized = serialize_docs(docs)
     
+    answer_cache.set('movie_info', question, generation, serialized, vector)
     return {'result': serialized}
 
+def serialize_docs(docs) -> str:
+    """Documents for the prompt, with only the metadata the model needs."""
+
+    return "\n\n".join(
+        (f"Source: {doc.metadata.get('source')} ({doc.metadata.get('sql_db_title')}, {doc.metadata.get('type')})\n" f"Content: {doc.page_content}")
+        for doc in docs)
+
+def cache_question(question: str) -> str:
+    """Date-resolved form of the question prefixed with today's date, so that cached answers don't outlive the day
+    they were given on, whether or not the question names a date."""
+
+    return f"{datetime.now().strftime('%Y-%m-%d')} {resolve_dates(question) or question}"
+
+@metrics.timed()
 def write_query(state: State) -> dict:
     """Generate SQL query to fetch information about movies timetable."""
     
     input = state['question']
-    prompt = prompt_template_SQL.format(dialect=db.dialect, top_k=10, table_info=db.get_table_info(), input=input)
+    prompt = prompt_template_SQL.format(dialect=db.dialect, top_k=10, table_info=table_info_cache.get_table_info(), input=input)
     structured_llm = llm.with_structured_output(QueryOutput)
-    try:
-        result = structured_llm.invoke(prompt)
-    except HTTPStatusError:
-        print('sleeping in write_query')
-        time.sleep(2)
-        result = structured_llm.invoke(prompt)
+    result = llm_client.invoke(structured_llm, prompt)
     
     return {'query': result.query}
 
+@metrics.timed()
 def execute_query(state: State):
-    """Execute SQL query."""
+    """Execute SQL query through the guard: read-only, bounded in rows, time and cost, with a result fit for the prompt."""
     
     query = state['query']
-    execute_query_tool = QuerySQLDatabaseTool(db=db)
-    result = execute_query_tool.invoke(query)
+    try:
+        result = sql_guard.run(query)
+    except UnsafeQuery as e:
+        metrics.count('sql_rejected')
+        result = f"Error: query rejected, {e}"
+    except SQLAlchemyError as e: # e.g. the timeout, returned to the model as QuerySQLDatabaseTool did
+        result = f"Error: {e}"
     return {'result': result}
 
 @tool
+@metrics.timed()
+def find_showtimes(state: State):
+    """Retrieve information about movies timetable: which movies are playing, where and when.
+    Relative dates and times in the question (today, tonight, tomorrow, this weekend...) are resolved first,
+    so there is no need to call date_tool before this tool."""
+
+    question = resolve_question(state['question'])
+    return {'question': question, **query_timetable_db({**state, 'question': question})}
+
+@metrics.timed()
 def query_timetable_db(state: State):  
-    """Access the database to retrieve information about movies timetable. 
-    This tool will first generate an SQL query based on the user's question and then execute it to fetch the required information."""
+    """Access the database to retrieve information about movies timetable: from the answer cache, the listing template,
+    or else an SQL query generated from the date-resolved question."""
     
+    question, generation = cache_question(state['question']), table_info_cache.refresh()
+    cached = answer_cache.get('timetable', question, generation)
+    if cached is not None:
+        return {'result': cached}
+
+    intent = match_intent(state['question'], table_info_cache.cinemas, table_info_cache.languages, table_info_cache.titles)
+    if intent: # common questions are answered by a parameterized template, without generating SQL
+        with metrics.stage('template_query'):
+            if TIMETABLE_SNAPSHOT and timetable_snapshot.refresh(): # no database round trip, and available during outages
+                result = {'result': snapshot_intent(timetable_snapshot, intent)}
+            else:
+                try:
+                    result = {'result': query_intent(engine, intent)}
+                except SQLAlchemyError as e:
+                    return {'result': f"Error: {e}"}
+        answer_cache.set('timetable', question, generation, result['result'])
+        return result
+
+    vector = None
+    scope = match_entities(state['question'], table_info_cache.cinemas, table_info_cache.languages, table_info_cache.titles)
+    if ANSWER_CACHE_SEMANTIC:
+        try:
+            with metrics.stage('embed_query'):
+                vector = embeddings.embed_query(question)
+        except (HTTPStatusError, TransportError) as e:
+            logging.warning(f"Skipping the semantic cache lookup of the timetable: {e!r}")
+    cached = answer_cache.get_similar('timetable', question, generation, vector, scope)
+    if cached is not None:
+        return {'result': cached}
+
     query = write_query(state)
     result = execute_query(query)
 
+    if not str(result['result']).startswith('Error:'): # timeouts and rejections are not answers
+        answer_cache.set('timetable', question, generation, str(result['result']), vector, scope)
     return result
 
+@metrics.timed()
 def resolve_relative_date(user_prompt: str, today_date: str, today_time: str, day_of_week: str) -> str:
     """Use an LLM to resolve relative dates and rewrite user's message given today's date and day of the week."""
     
     prompt = prompt_template_relative_dates.format(today_date=today_date, today_time=today_time, day_of_week=day_of_week, user_prompt=user_prompt)
-    try:
-        updated_prompt = llm.invoke(prompt) 
-    except HTTPStatusError:
-        print('sleeping in resolve_relative_date')
-        time.sleep(2)
-        updated_prompt = llm.invoke(prompt) 
+    updated_prompt = llm_client.invoke(llm, prompt)
     return updated_prompt
 
-tools = [date_tool, retrieve_movie_info, query_timetable_db]
+tools = [date_tool, retrieve_movie_info, find_showtimes] # date resolution and timetable query fused, one model step less
 llm_with_tools = llm.bind_tools(tools)
+llm_without_tools = llm.bind_tools(tools, tool_choice="none") # final answer once the tool budget of the request is spent
@@ -0,0 +1,225 @@
+"""Per-stage metrics of the bot: wall time, tokens, retries, cache hits and tool-loop iterations.
+
+Every observation is kept in memory for the Prometheus text format and, if METRICS_LOG is set,
+appended to it as a JSON line. The report prints the latency percentiles per stage from that log:
+
+    python -m LLM.metrics                  # report of METRICS_LOG
+    python -m LLM.metrics other.jsonl --since 3600
+"""
+
+import os, sys, json, time, logging, argparse, threading, functools, inspect, contextvars
+from logging.handlers import RotatingFileHandler
+from collections import defaultdict
+from contextlib import contextmanager
+from langchain_core.callbacks import BaseCallbackHandler
+
+METRICS_LOG = os.getenv("METRICS_LOG", '') # path of the structured log, e.g. metrics.jsonl; empty to disable it
+METRICS_LOG_MAX_BYTES = int(os.getenv("METRICS_LOG_MAX_BYTES", 50 * 2**20)) # size at which the log is rotated
+METRICS_LOG_BACKUPS = int(os.getenv("METRICS_LOG_BACKUPS", 3)) # rotated files kept
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0)) # port of the Prometheus endpoint, 0 to disable
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+current_stage = contextvars.ContextVar('current_stage', default='other')
+
+log = logging.getLogger('metrics')
+log.propagate = False
+if METRICS_LOG:
+    handler = RotatingFileHandler(METRICS_LOG, maxBytes=METRICS_LOG_MAX_BYTES, backupCount=METRICS_LOG_BACKUPS,
+                                  delay=True) # the file is opened by the first observation
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+
+
+class Histogram():
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+class Metrics():
+    """Thread-safe registry of the histograms and counters, labelled by stage."""
+
+    def __init__(self):
+        self.histograms = defaultdict(Histogram) # (name, stage) -> histogram
+        self.counters = defaultdict(float) # (name, labels) -> value
+        self.collectors = {} # name -> function returning counters kept elsewhere, e.g. by the caches
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        if log.handlers:
+            log.info(json.dumps({'ts': round(time.time(), 3), 'event': event, **fields}, default=str))
+
+    def observe(self, name, stage, value, **fields):
+        with self.lock:
+            self.histograms[(name, stage)].observe(value)
+        self.emit(name, stage=stage, value=round(value, 6), **fields)
+
+    def count(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+        self.emit(name, value=value, **labels)
+
+    def add_collector(self, name, func):
+        self.collectors[name] = func
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """Time the block as a stage; tokens and retries inside it are counted for the stage."""
+
+        token = current_stage.set(name)
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            current_stage.reset(token)
+            self.observe('stage_seconds', name, time.perf_counter() - start, status=status, **fields)
+
+    def timed(self, name=None):
+        """Decorator timing a sync or async function as a stage."""
+
+        def decorator(func):
+            stage = name or func.__name__
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.stage(stage):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def tokens(self, message):
+        """Count the token usage of a model response for the current stage."""
+
+        usage = getattr(message, 'usage_metadata', None) or {}
+        for kind in ('input_tokens', 'output_tokens'):
+            if usage.get(kind):
+                self.count('tokens', usage[kind], stage=current_stage.get(), kind=kind.split('_')[0])
+
+    def render(self) -> str:
+        """Metrics in the Prometheus text exposition format."""
+
+        lines, types = [], set()
+        def declare(metric, kind):
+            if metric not in types:
+                types.add(metric)
+                lines.append(f'# TYPE {metric} {kind}')
+
+        with self.lock:
+            for (name, stage), histogram in sorted(self.histograms.items()):
+                declare(f'bot_{name}', 'histogram')
+                for bound, value in zip(BUCKETS, histogram.buckets):
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'bot_{name}_bucket{{stage="{stage}",le="{le}"}} {value}')
+                lines.append(f'bot_{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'bot_{name}_count{{stage="{stage}"}} {histogram.count}')
+            for (name, labels), value in sorted(self.counters.items()):
+                declare(f'bot_{name}_total', 'counter')
+                label_text = ','.join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f'bot_{name}_total{{{label_text}}} {value}')
+        for name, func in self.collectors.items():
+            declare(f'bot_{name}', 'gauge')
+            for key, value in func().items():
+                lines.append(f'bot_{name}{{key="{key}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=METRICS_PORT):
+        """Expose /metrics over HTTP in a daemon thread."""
+
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class TokenCallback(BaseCallbackHandler):
+    """Counts the tokens of every call of the model it is attached to, for the stage it runs in."""
+
+    run_inline = True # in the context of the caller, which holds the stage
+
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                metrics.tokens(getattr(generation, 'message', None))
+
+
+metrics = Metrics()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+def report(path=METRICS_LOG, since=None):
+    """Latency percentiles, tokens and retries per stage from the structured log and its rotated files."""
+
+    timings, tokens, retries, iterations = defaultdict(list), defaultdict(float), defaultdict(float), []
+    start = time.time() - since if since else 0
+    paths = [f'{path}.{i}' for i in range(METRICS_LOG_BACKUPS, 0, -1) if os.path.exists(f'{path}.{i}')] + [path]
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get('ts', 0) < start:
+                    continue
+                if record['event'] == 'stage_seconds':
+                    timings[record['stage']].append(record['value'])
+                elif record['event'] == 'tokens':
+                    tokens[(record['stage'], record['kind'])] += record['value']
+                elif record['event'] == 'llm_retries':
+                    retries[record['stage']] += record['value']
+                elif record['event'] == 'tool_iterations':
+                    iterations.append(record['value'])
+
+    print(f"{'stage':<24} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'in tok':>9} {'out tok':>9} {'retries':>8}")
+    for stage, values in sorted(timings.items(), key=lambda item: -sum(item[1])):
+        print(f"{stage:<24} {len(values):>7} {percentile(values, 0.5) * 1000:>9.1f} {percentile(values, 0.95) * 1000:>9.1f} "
+              f"{max(values) * 1000:>9.1f} {tokens[(stage, 'input')]:>9.0f} {tokens[(stage, 'output')]:>9.0f} {retries[stage]:>8.0f}")
+    if iterations:
+        print(f"tool iterations per request: p50 {percentile(iterations, 0.5):.0f}, p95 {percentile(iterations, 0.95):.0f}, "
+              f"max {max(iterations):.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', default=METRICS_LOG)
+    parser.add_argument('--since', type=float, help='only the last N seconds')
+    args = parser.parse_args()
+    if not args.path or not os.path.exists(args.path):
+        sys.exit(f'No metrics log at {args.path!r}')
+    report(args.path, args.since)
@@ -0,0 +1,162 @@
+import os, re, math, time, threading
+from collections import Counter
+from typing import Optional
+from langchain_core.documents import Document
+
+RETRIEVAL_REFRESH = float(os.getenv('RETRIEVAL_REFRESH', 60)) # seconds between checks of the collection version
+RETRIEVAL_K = int(os.getenv('RETRIEVAL_K', 3))
+RRF_K = 60 # constant of the reciprocal rank fusion
+PERSON_CUES = re.compile(r"\b(directed|directors?|regist[ai]|regia|diretto|starring|actors?|actress|attor[ei]|attric[ei]|cast|interpretato)\b")
+GENERIC_WORDS = {'what', 'which', 'there', 'some', 'good', 'best', 'great', 'movie', 'movies', 'film', 'films', 'show', 'recommend',
+                 'suggest', 'playing', 'watch', 'genre', 'dammi', 'consigliami', 'qualche', 'quali', 'quale', 'bello', 'belli',
+                 'buoni', 'genere'} # words of a question asking only for a genre
+
+GENRES = { # Italian names of the TMDB genres
+    'animazione': 'animation', 'avventura': 'adventure', 'azione': 'action', 'commedia': 'comedy', 'documentario': 'documentary',
+    'dramma': 'drama', 'drammatico': 'drama', 'famiglia': 'family', 'fantascienza': 'science fiction', 'guerra': 'war',
+    'musicale': 'music', 'poliziesco': 'crime', 'romantico': 'romance', 'storico': 'history', 'western': 'western',
+    }
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r'\w+', text.lower())
+
+def contains(text: str, phrase: str) -> bool:
+    return re.search(rf'(?<!\w){re.escape(phrase)}(?!\w)', text) is not None
+
+
+class BM25():
+    """Okapi BM25 keyword index over the documents."""
+
+    def __init__(self, documents: list[Document], k1=1.5, b=0.75):
+        self.k1, self.b = k1, b
+        self.terms = [Counter(tokenize(doc.page_content)) for doc in documents]
+        self.lengths = [sum(terms.values()) for terms in self.terms]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        frequencies = Counter(term for terms in self.terms for term in terms)
+        n = len(documents)
+        self.idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in frequencies.items()}
+
+    def scores(self, query: str) -> list[float]:
+        query_terms = [term for term in tokenize(query) if term in self.idf]
+        scores = []
+        for terms, length in zip(self.terms, self.lengths):
+            score = 0.0
+            for term in query_terms:
+                tf = terms.get(term, 0)
+                if tf:
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / self.average_length))
+            scores.append(score)
+        return scores
+
+
+class HybridRetriever():
+    """Movie retrieval by exact titles and metadata filters first, then by fusing BM25 and vector search."""
+
+    def __init__(self, vectordb, version=None, refresh=RETRIEVAL_REFRESH):
+        self.vectordb = vectordb
+        self.version = version # function returning the version of the documents, bumped by their writers
+        self.refresh = refresh
+        self.loaded = None # (version, count) of the indexed documents
+        self.checked_at = 0.0
+        self.documents = []
+        self.bm25 = None
+        self.titles = {} # normalized title -> documents of the movie
+        self.directors = {} # lowercased name -> documents of the movies
+        self.cast = {}
+        self.genres = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Rebuild the indexes when the documents of the collection were written, e.g. refreshed in place, or added."""
+
+        with self.lock:
+            if self.loaded is not None and time.monotonic() - self.checked_at < self.refresh:
+                return
+            self.checked_at = time.monotonic()
+            loaded = (self.version() if self.version else None, self.vectordb._collection.count())
+            if loaded == self.loaded:
+                return
+            stored = self.vectordb.get(include=['documents', 'metadatas'])
+            documents = [Document(page_content=content, metadata=metadata or {}, id=idx)
+                         for idx, content, metadata in zip(stored['ids'], stored['documents'], stored['metadatas'])]
+            titles, directors, cast, genres = {}, {}, {}, {}
+            for doc in documents:
+                metadata = doc.metadata
+                for title in {metadata.get('sql_db_title'), metadata.get('title'), metadata.get('original_title')}:
+                    if title and len(title) >= 3:
+                        titles.setdefault(title.lower(), []).append(doc)
+                for field, index in (('director', directors), ('cast', cast), ('genres', genres)):
+                    for name in (metadata.get(field) or '').split(', '):
+                        if name:
+                            index.setdefault(name.lower(), []).append(doc)
+            self.documents, self.bm25 = documents, BM25(documents)
+            self.titles, self.directors, self.cast, self.genres = titles, directors, cast, genres
+            self.loaded = loaded
+
+    @staticmethod
+    def match_people(question: str, index: dict) -> list[Document]:
+        """Documents of the people named in the question, by full name or, if the question is about people, by surname."""
+
+        by_surname = PERSON_CUES.search(question) is not None
+        docs = []
+        for name, name_docs in index.items():
+            surname = name.split()[-1]
+            if contains(question, name) or (by_surname and len(surname) >= 4 and contains(question, surname)):
+                docs += name_docs
+        return docs
+
+    def structured(self, question: str, k: int = 5) -> Optional[list[Document]]:
+        """Answer from exact title matches or metadata filters, without embeddings.
+        Returns None if the question names no known title or person, and no genre alone."""
+
+        self.load()
+        question = question.lower()
+        titles = [title for title in self.titles if contains(question, title)]
+        if titles:
+            longest = [title for title in titles if not any(title != other and title in other for other in titles)]
+            return unique([doc for title in longest for doc in self.titles[title]])
+
+        people = self.match_people(question, self.directors) + self.match_people(question, self.cast)
+        genres, genre_words = [], set()
+        for genre, docs in self.genres.items():
+            named = [name for name in [genre] + [word for word, name in GENRES.items() if name == genre] if contains(question, name)]
+            if named:
+                genres += docs
+                genre_words.update(word for name in named for word in tokenize(name))
+        if not people and (not genres or self.asks_more(question, genre_words)):
+            return None # a genre together with other criteria, e.g. about the plot, is left to the hybrid search
+        info = [doc for doc in unique(people + genres) if doc.metadata.get('type') == 'info']
+        return info[:k]
+
+    @staticmethod
+    def asks_more(question: str, genre_words: set) -> bool:
+        """Whether the question has words besides the genre and the generic ones of a request for movies."""
+
+        return any(len(word) > 3 and word not in GENERIC_WORDS and word not in genre_words for word in tokenize(question))
+
+    def hybrid(self, question: str, vector, k: int = RETRIEVAL_K) -> list[Document]:
+        """Reciprocal rank fusion of BM25 and vector search."""
+
+        self.load()
+        candidates = max(k * 4, 10)
+        ranks = Counter()
+        documents = {}
+        if self.bm25:
+            scores = self.bm25.scores(question)
+            ranked = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])[:candidates]
+            for rank, i in enumerate(ranked):
+                doc = self.documents[i]
+                documents[key(doc)] = doc
+                ranks[key(doc)] += 1 / (RRF_K + rank)
+        for rank, doc in enumerate(self.vectordb.similarity_search_by_vector(vector, k=candidates)):
+            documents.setdefault(key(doc), doc)
+            ranks[key(doc)] += 1 / (RRF_K + rank)
+        return [documents[idx] for idx, _ in ranks.most_common(k)]
+
+
+def key(doc: Document) -> str:
+    return doc.id or doc.page_content
+
+def unique(docs: list[Document]) -> list[Document]:
+    return list({key(doc): doc for doc in docs}.values())
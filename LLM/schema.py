@@ -0,0 +1,61 @@
+import os, time, threading
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from database.extract import get_generation
+
+DB_TABLE = os.getenv('DB_TABLE')
+SCHEMA_CACHE_TTL = float(os.getenv('SCHEMA_CACHE_TTL', 60)) # seconds between checks of the timetable version
+
+
+class TableInfoCache():
+    """Table info for SQL generation together with the known cinemas, languages and titles.
+    It is rebuilt only when the timetable is reloaded, which is detected through the generation marker,
+    and kept as it is while the database is unreachable."""
+
+    def __init__(self, db, engine, ttl=SCHEMA_CACHE_TTL):
+        self.db = db
+        self.engine = engine
+        self.ttl = ttl
+        self.generation = None
+        self.checked_at = 0.0
+        self.table_info = ''
+        self.cinemas = []
+        self.languages = []
+        self.titles = []
+        self.lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """Rebuild the cache if the timetable was reloaded since the last build; return the generation of the build."""
+
+        with self.lock:
+            if not force and self.generation is not None and time.monotonic() - self.checked_at < self.ttl:
+                return self.generation
+            generation = get_generation(self.engine) # 0 if the database is unreachable
+            self.checked_at = time.monotonic()
+            if force or (generation != self.generation and not (generation == 0 and self.generation)):
+                try:
+                    self.build(generation)
+                except SQLAlchemyError as e:
+                    print(f"Error: {e}")
+            return self.generation
+
+    def build(self, generation):
+        with self.engine.connect() as connection:
+            self.cinemas = self.distinct(connection, 'cinema')
+            self.languages = self.distinct(connection, 'language')
+            self.titles = self.distinct(connection, 'title')
+        self.table_info = f"""{self.db.get_table_info()}
+
+Cinemas: {", ".join(self.cinemas)}
+Languages: {", ".join(self.languages)}
+Titles: {", ".join(self.titles)}"""
+        self.generation = generation
+
+    @staticmethod
+    def distinct(connection, column):
+        rows = connection.execute(text(f"SELECT DISTINCT {column} FROM {DB_TABLE} WHERE {column} IS NOT NULL ORDER BY {column}"))
+        return [row[0] for row in rows]
+
+    def get_table_info(self):
+        self.refresh()
+        return self.table_info
@@ -0,0 +1,225 @@
+import re, os, json, time
+from collections import Counter
+from sqlalchemy import text
+from langchain_community.utilities.sql_database import truncate_word
+
+SQL_ROW_LIMIT = int(os.getenv('SQL_ROW_LIMIT', 50)) # LIMIT forced on generated queries
+SQL_TIMEOUT = float(os.getenv('SQL_TIMEOUT', 5)) # seconds of execution on the database server
+SQL_MAX_COST = float(os.getenv('SQL_MAX_COST', 1e6)) # highest MySQL EXPLAIN query cost, 0 to skip the plan check
+SQL_MAX_RESULT_CHARS = int(os.getenv('SQL_MAX_RESULT_CHARS', 4000)) # longer results are cut before reaching the LLM
+MAX_STRING_LENGTH = 300 # as QuerySQLDatabaseTool
+
+TOKEN = re.compile(r"""(?P<space>\s+)|(?P<comment>--[^\n]*|\#[^\n]*|/\*.*?\*/)|(?P<literal>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+    |(?P<quoted>`(?:[^`]|``)*`)|(?P<word>\w+)|(?P<other><=|>=|<>|!=|\|\||/\*|.)""", re.DOTALL | re.VERBOSE)
+FORBIDDEN = {'INSERT', 'UPDATE', 'DELETE', 'MERGE', 'UPSERT', 'DROP', 'ALTER', 'CREATE', 'TRUNCATE', 'RENAME', 'GRANT', 'REVOKE',
+             'CALL', 'EXEC', 'EXECUTE', 'DO', 'HANDLER', 'LOAD', 'LOAD_FILE', 'LOCK', 'UNLOCK', 'SET', 'INTO', 'OUTFILE', 'DUMPFILE',
+             'SLEEP', 'BENCHMARK', 'RECURSIVE', 'PRAGMA', 'ATTACH', 'DETACH', 'VACUUM', 'SHUTDOWN', 'KILL'}
+BIND = re.compile(r'(?<![:\w\\]):(?=\w)') # what text() would read as a bind parameter
+CLAUSES = {'WHERE', 'GROUP', 'HAVING', 'ORDER', 'LIMIT', 'UNION', 'INTERSECT', 'EXCEPT', 'WINDOW'}
+
+
+class UnsafeQuery(ValueError):
+    pass
+
+
+class Token():
+    def __init__(self, kind, value, depth):
+        self.kind = kind
+        self.value = value
+        self.depth = depth # parentheses around the token
+
+    @property
+    def keyword(self):
+        return self.value.upper() if self.kind == 'word' else None
+
+
+def tokenize(sql: str) -> list[Token]:
+    """Tokens of the query, without comments; literals and quoted names are single tokens."""
+
+    tokens, depth = [], 0
+    for match in TOKEN.finditer(sql):
+        kind, value = match.lastgroup, match.group()
+        if kind == 'comment':
+            kind, value = 'space', ' '
+        elif value in ("'", '"', '`', '/*'):
+            raise UnsafeQuery('unterminated literal or comment')
+        elif value == ')':
+            depth -= 1
+            if depth < 0:
+                raise UnsafeQuery('unbalanced parentheses')
+        tokens.append(Token(kind, value, depth))
+        if value == '(':
+            depth += 1
+    if depth:
+        raise UnsafeQuery('unbalanced parentheses')
+    return tokens
+
+def statement(sql: str):
+    """The query as text(), so the dialect escapes % for drivers with the format paramstyle (PyMySQL),
+    with the colons that would read as bind parameters escaped."""
+
+    return text(BIND.sub(r'\\:', sql))
+
+def table_name(tokens: list[Token], i: int) -> str:
+    """Unquoted name of the table starting at token i, without the database prefix."""
+
+    name = tokens[i].value
+    while i + 2 < len(tokens) and tokens[i + 1].value == '.':
+        i += 2
+        name = tokens[i].value
+    return name.strip('`"').lower()
+
+
+class SQLGuard():
+    """Validation and bounded execution of the SQL written by the LLM.
+    Only a single SELECT over the allowed tables passes; a LIMIT is enforced, the server stops the query after
+    the timeout, queries with a costly plan are rejected and the result is cut to a size fit for the prompt."""
+
+    def __init__(self, engine, tables, row_limit=SQL_ROW_LIMIT, timeout=SQL_TIMEOUT, max_cost=SQL_MAX_COST,
+                 max_chars=SQL_MAX_RESULT_CHARS):
+        self.engine = engine
+        self.tables = {table.lower() for table in tables}
+        self.row_limit = row_limit
+        self.timeout = timeout
+        self.max_cost = max_cost
+        self.max_chars = max_chars
+
+    def validate(self, sql: str) -> str:
+        """Return the query to run, with the enforced LIMIT and timeout hint, or raise UnsafeQuery."""
+
+        tokens = tokenize(sql.strip())
+        code = [token for token in tokens if token.kind != 'space']
+        while code and code[-1].value == ';':
+            tokens.remove(code.pop())
+        if not code:
+            raise UnsafeQuery('empty query')
+        if any(token.value == ';' for token in code):
+            raise UnsafeQuery('only one statement is allowed')
+        if code[0].keyword not in ('SELECT', 'WITH'):
+            raise UnsafeQuery('only SELECT queries are allowed')
+        forbidden = {token.keyword for token in code} & FORBIDDEN
+        if forbidden:
+            raise UnsafeQuery(f"{', '.join(sorted(forbidden))} not allowed")
+        self.check_tables(code)
+        return self.bound(tokens, code)
+
+    def check_tables(self, code: list[Token]):
+        """Only the allowed tables and the CTEs of the query may be read, and every join needs a condition."""
+
+        allowed = self.tables | {code[i - 2].value.strip('`"').lower() for i in range(2, len(code))
+                                 if code[i].value == '(' and code[i - 1].keyword == 'AS'} # WITH name AS (...)
+        groups = [{'select': True, 'tables': 0, 'conditions': 0, 'in_from': False}]
+        for i, token in enumerate(code):
+            group = groups[-1]
+            if token.value == '(':
+                groups.append({'select': i + 1 < len(code) and code[i + 1].keyword in ('SELECT', 'WITH'),
+                               'tables': 0, 'conditions': 0, 'in_from': False})
+            elif token.value == ')':
+                self.check_joins(groups.pop())
+            elif not group['select']:
+                continue
+            elif token.keyword in ('FROM', 'JOIN'):
+                group['in_from'] = True
+                if token.keyword == 'JOIN' and code[i - 1].keyword in ('CROSS', 'NATURAL'):
+                    raise UnsafeQuery('cross joins are not allowed')
+                if i + 1 < len(code) and code[i + 1].value != '(':
+                    name = table_name(code, i + 1)
+                    if name not in allowed:
+                        raise UnsafeQuery(f'table {name} is not allowed')
+                group['tables'] += 1
+            elif token.keyword in ('ON', 'USING'):
+                group['conditions'] += 1
+            elif token.value == ',' and group['in_from']:
+                group['tables'] += 1 # comma join, counted without a condition
+            elif token.keyword in CLAUSES or token.keyword == 'SELECT':
+                group['in_from'] = False
+        self.check_joins(groups.pop())
+
+    @staticmethod
+    def check_joins(group):
+        if group['select'] and group['tables'] > group['conditions'] + 1:
+            raise UnsafeQuery('every joined table needs an ON or USING condition')
+
+    def bound(self, tokens: list[Token], code: list[Token]) -> str:
+        """Enforce the row limit on the outer query and add the MySQL timeout hint."""
+
+        limits = [i for i, token in enumerate(code) if token.keyword == 'LIMIT' and token.depth == 0]
+        if limits:
+            args = code[limits[-1] + 1:]
+            if len(args) >= 3 and args[1].value == ',': # LIMIT offset, count
+                args = args[2:]
+            if not args or not args[0].value.isdigit():
+                raise UnsafeQuery('LIMIT must be a number')
+            if int(args[0].value) > self.row_limit:
+                args[0].value = str(self.row_limit)
+        if self.engine.dialect.name == 'mysql' and self.timeout: # the hint applies to the outer SELECT, after any CTE
+            select = next((token for token in code if token.keyword == 'SELECT' and token.depth == 0), None)
+            if select:
+                select.value += f' /*+ MAX_EXECUTION_TIME({int(self.timeout * 1000)}) */'
+        sql = ''.join(token.value for token in tokens).strip()
+        if not limits:
+            sql += f' LIMIT {self.row_limit}'
+        return sql
+
+    def check_cost(self, connection, sql: str):
+        """Reject the query if its plan is too costly: the MySQL cost estimate, or full scans nested in one loop on SQLite."""
+
+        dialect = self.engine.dialect.name
+        if dialect == 'mysql' and self.max_cost:
+            plan = json.loads(connection.execute(statement(f'EXPLAIN FORMAT=JSON {sql}')).scalar())
+            cost = float(plan.get('query_block', {}).get('cost_info', {}).get('query_cost', 0))
+            if cost > self.max_cost:
+                raise UnsafeQuery(f'query too costly (estimated cost {cost:.0f}), add filters or conditions')
+        elif dialect == 'sqlite' and self.max_cost:
+            plan = connection.execute(statement(f'EXPLAIN QUERY PLAN {sql}')).all() # (id, parent, notused, detail)
+            scans = Counter(row[1] for row in plan if str(row[-1]).startswith('SCAN ') and 'CONSTANT ROW' not in str(row[-1]))
+            if any(count > 1 for count in scans.values()):
+                raise UnsafeQuery('query too costly (nested full scans), add filters or conditions')
+
+    def set_timeout(self, connection):
+        """Server-side timeout where it is not given as a hint in the query."""
+
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql':
+            connection.exec_driver_sql(f'SET LOCAL statement_timeout = {int(self.timeout * 1000)}')
+        elif dialect == 'sqlite':
+            deadline = time.monotonic() + self.timeout
+            connection.connection.driver_connection.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+
+    def clear_timeout(self, connection):
+        if self.engine.dialect.name == 'sqlite':
+            connection.connection.driver_connection.set_progress_handler(None, 0)
+
+    def run(self, sql: str) -> str:
+        """Validate and execute the query, returning the rows as QuerySQLDatabaseTool does."""
+
+        sql = self.validate(sql)
+        with self.engine.begin() as connection:
+            self.check_cost(connection, sql)
+            if self.timeout:
+                self.set_timeout(connection)
+            try:
+                rows = connection.execute(statement(sql)).fetchmany(self.row_limit)
+            finally:
+                if self.timeout:
+                    self.clear_timeout(connection)
+        return self.format(rows)
+
+    def format(self, rows) -> str:
+        """Rows as a list of tuples, cut to max_chars with a note on the rows left out."""
+
+        rows = [str(tuple(truncate_word(value, length=MAX_STRING_LENGTH) for value in row)) for row in rows]
+        if not rows:
+            return ''
+        shown, size = [], 2
+        for row in rows:
+            size += len(row) + 2
+            if shown and size > self.max_chars:
+                break
+            shown.append(row)
+        result = '[' + ', '.join(shown) + ']'
+        if len(shown) < len(rows):
+            result += f'\n(only {len(shown)} of {len(rows)} rows shown, ask a narrower question for the rest)'
+        elif len(rows) == self.row_limit:
+            result += f'\n(limited to {self.row_limit} rows)'
+        return result
@@ -0,0 +1,222 @@
+import re, os
+from datetime import date
+from difflib import SequenceMatcher
+from typing import Optional
+from typing_extensions import TypedDict
+from sqlalchemy import text, bindparam
+
+DB_TABLE = os.getenv('DB_TABLE')
+TEMPLATE_ROW_LIMIT = int(os.getenv('TEMPLATE_ROW_LIMIT', 200))
+FUZZY_THRESHOLD = 0.85
+
+LANGUAGE_WORDS = {
+    'en': ('english', 'inglese', 'original language', 'original version', 'lingua originale', 'versione originale', 'v.o.', 'subtitled', 'sottotitolato', 'sottotitoli'),
+    'it': ('italian', 'italiano'),
+    'jp': ('japanese', 'giapponese'),
+    'kor': ('korean', 'coreano'),
+    }
+# Questions the listing template can't answer
+UNSUPPORTED = re.compile(
+    r"\b(how many|how long|count|number of|latest|last|earliest|first|longest|shortest|average|most|least|"
+    r"quant[iea]|quanto|numero|ultim[oaie]|più|meno|media)\b", re.IGNORECASE)
+# Criteria the listing template can't filter on
+UNEXPRESSED = re.compile(
+    r"\b(directed|directors?|regist[ai]|regia|diretto|starring|actors?|actress|attor[ei]|attric[ei]|cast|interpretato|"
+    r"genres?|gener[ei]|animation|animazione|adventure|avventura|action|azione|comedy|comedies|commedi[ae]|documentar(?:y|ies|io|i)|"
+    r"drama|dramm[ai]|drammatic[oi]|family|famiglia|fantasy|science fiction|fantascienza|horror|thriller|war|guerra|"
+    r"musical|musicale|crime|poliziesc[oi]|romance|romantic[oi]|history|storic[oi]|western|rated|rating|voto|recensioni)\b",
+    re.IGNORECASE)
+CINEMA_STOPWORDS = {'cinema', 'cinemas', 'circuito', 'the', 'uci', 'multisala'}
+
+DATE = r"\d{4}-\d{2}-\d{2}"
+TIME = r"\d{1,2}:\d{2}"
+DATE_RANGE = re.compile(rf"(?:from|dal|between|tra)\s+({DATE})\s+(?:to|al|and|e)\s+({DATE})", re.IGNORECASE)
+TIME_RANGE = re.compile(rf"(?:from|dalle|between|tra le)\s+({TIME})\s+(?:to|alle|and|e le)\s+({TIME})", re.IGNORECASE)
+TIME_AFTER = re.compile(rf"(?:after|from|dopo le|dalle)\s+({TIME})", re.IGNORECASE)
+TIME_BEFORE = re.compile(rf"(?:before|until|by|prima delle|entro le|fino alle)\s+({TIME})", re.IGNORECASE)
+
+
+class Intent(TypedDict):
+    title: Optional[str]
+    cinemas: list[str]
+    language: Optional[str]
+    date_from: Optional[str]
+    date_to: Optional[str]
+    time_from: Optional[str]
+    time_to: Optional[str]
+
+
+def normalize(s: str) -> str:
+    """Normalize text the same way the crawler cleans titles."""
+
+    s = s.lower()
+    s = re.sub(r"[\:\-–,.;!?\"“”«»()]", ' ', s)
+    return re.sub(r'\s+', ' ', s).strip()
+
+def compact(s: str) -> str:
+    return re.sub(r'[^a-z0-9àèéìòù]', '', s.lower())
+
+def fuzzy_contains(phrase: str, words: list[str]) -> float:
+    """Return the best similarity of the phrase to any run of words of the same length."""
+
+    n = len(phrase.split())
+    best = 0.0
+    for i in range(len(words) - n + 1):
+        best = max(best, SequenceMatcher(None, phrase, ' '.join(words[i:i+n])).ratio())
+    return best
+
+def match_title(question: str, titles: list[str]) -> Optional[str]:
+    """Find the known title mentioned in the question, tolerating small typos."""
+
+    padded = f' {question} '
+    exact = [title for title in titles if len(title) >= 3 and f' {normalize(title)} ' in padded]
+    if exact:
+        return max(exact, key=len)
+    words = question.split()
+    scored = [(fuzzy_contains(normalize(title), words), title) for title in titles if len(title) >= 4]
+    scored = [item for item in scored if item[0] >= FUZZY_THRESHOLD]
+    if scored:
+        return max(scored)[1]
+    return None
+
+def match_cinemas(question: str, cinemas: list[str]) -> list[str]:
+    """Find the cinemas mentioned in the question."""
+
+    compact_question = compact(question)
+    words = question.split()
+    matched = []
+    for cinema in cinemas:
+        if compact(cinema) in compact_question:
+            matched.append(cinema)
+            continue
+        tokens = [token for token in normalize(cinema).split() if token not in CINEMA_STOPWORDS and len(token) >= 3]
+        if any(fuzzy_contains(token, words) >= FUZZY_THRESHOLD for token in tokens):
+            matched.append(cinema)
+    if not matched and 'circuito' in question:
+        matched = [cinema for cinema in cinemas if cinema.lower().startswith('circuito')]
+    if not matched and 'uci' in words:
+        matched = [cinema for cinema in cinemas if cinema.lower().startswith('uci')]
+    return matched
+
+def match_language(question: str, languages: list[str]) -> Optional[str]:
+    for language, words in LANGUAGE_WORDS.items():
+        if language in languages and any(re.search(rf'(?<!\w){re.escape(word)}(?!\w)', question) for word in words):
+            return language
+    return None
+
+def match_entities(question: str, cinemas: list[str], languages: list[str], titles: list[str]) -> str:
+    """Title, cinemas and language named in the question, which questions sharing a cached answer must have in common."""
+
+    lowered = question.lower()
+    text_only = normalize(re.sub(rf"{DATE}|{TIME}", ' ', lowered))
+    entities = [match_title(text_only, titles) or '', ','.join(sorted(match_cinemas(text_only, cinemas))),
+                match_language(lowered, languages) or '']
+    return '|'.join(entities) if any(entities) else ''
+
+def match_intent(question: str, cinemas: list[str], languages: list[str], titles: list[str]) -> Optional[Intent]:
+    """Map a date-resolved question to the showtime listing template.
+    Returns None if the question needs the free-form SQL generation."""
+
+    if UNSUPPORTED.search(question):
+        return None
+
+    lowered = question.lower()
+    intent = Intent(title=None, cinemas=[], language=None, date_from=None, date_to=None, time_from=None, time_to=None)
+
+    dates = re.findall(DATE, lowered)
+    date_range = DATE_RANGE.search(lowered)
+    if date_range:
+        intent['date_from'], intent['date_to'] = sorted(date_range.groups())
+    elif len(dates) == 1:
+        intent['date_from'] = intent['date_to'] = dates[0]
+    elif dates:
+        return None
+
+    times = re.findall(TIME, lowered)
+    time_range, time_after, time_before = TIME_RANGE.search(lowered), TIME_AFTER.search(lowered), TIME_BEFORE.search(lowered)
+    if time_range:
+        intent['time_from'], intent['time_to'] = time_range.groups()
+    else:
+        intent['time_from'] = time_after.group(1) if time_after else None
+        intent['time_to'] = time_before.group(1) if time_before else None
+    if len(times) != bool(intent['time_from']) + bool(intent['time_to']):
+        return None
+    if not time_range and intent['time_from'] and intent['time_to'] and intent['time_from'] > intent['time_to']:
+        return None # "after 21:00 or before 13:00"
+
+    text_only = normalize(re.sub(rf"{DATE}|{TIME}", ' ', lowered))
+    intent['title'] = match_title(text_only, titles)
+    intent['cinemas'] = match_cinemas(text_only, cinemas)
+    intent['language'] = match_language(lowered, languages)
+    criteria = f' {text_only} '
+    for name in [intent['title'] or ''] + intent['cinemas']:
+        criteria = criteria.replace(f' {normalize(name)} ', ' ')
+    if UNEXPRESSED.search(criteria):
+        return None
+
+    if not (intent['title'] or intent['cinemas'] or intent['date_from']):
+        return None
+    return intent
+
+
+def build_query(intent: Intent, today: Optional[date] = None):
+    """Fill the parameterized showtime listing template."""
+
+    conditions, params = [], {}
+    if intent['title']:
+        conditions.append('title = :title')
+        params['title'] = intent['title']
+    if intent['cinemas']:
+        conditions.append('cinema IN :cinemas')
+        params['cinemas'] = intent['cinemas']
+    if intent['language']:
+        conditions.append('language = :language')
+        params['language'] = intent['language']
+    if intent['date_from']:
+        conditions.append('date BETWEEN :date_from AND :date_to')
+        params['date_from'], params['date_to'] = intent['date_from'], intent['date_to']
+    else:
+        conditions.append('date >= :today')
+        params['today'] = (today or date.today()).isoformat()
+    if intent['time_from']:
+        conditions.append('time >= :time_from')
+        params['time_from'] = intent['time_from']
+    if intent['time_to']:
+        conditions.append('time <= :time_to')
+        params['time_to'] = intent['time_to']
+    params['limit'] = TEMPLATE_ROW_LIMIT
+
+    query = text(f"""SELECT cinema, title, language, date, time, link FROM {DB_TABLE}
+WHERE {" AND ".join(conditions)}
+ORDER BY date, time LIMIT :limit""")
+    if intent['cinemas']:
+        query = query.bindparams(bindparam('cinemas', expanding=True))
+    return query, params
+
+def format_rows(rows) -> str:
+    """Group showtimes by movie, cinema and date to keep the tool output short."""
+
+    if not rows:
+        return 'No showings found.'
+    grouped = {}
+    for cinema, title, language, day, time, link in rows:
+        key = (title, language, cinema, str(day), link)
+        grouped.setdefault(key, []).append(str(time)[:5])
+    lines = [f"{title} ({language}) at {cinema} on {day}: {', '.join(times)} - {link}"
+             for (title, language, cinema, day, link), times in grouped.items()]
+    if len(rows) >= TEMPLATE_ROW_LIMIT:
+        lines.append(f'Only the first {TEMPLATE_ROW_LIMIT} showings are listed.')
+    return '\n'.join(lines)
+
+def query_intent(engine, intent: Intent) -> str:
+    """Execute the showtime listing template for the intent."""
+
+    query, params = build_query(intent)
+    with engine.connect() as connection:
+        rows = connection.execute(query, params).fetchall()
+    return format_rows(rows)
+
+def snapshot_intent(snapshot, intent: Intent) -> str:
+    """Answer the showtime listing template from the in-memory timetable snapshot."""
+
+    return format_rows(snapshot.query(**intent, limit=TEMPLATE_ROW_LIMIT))
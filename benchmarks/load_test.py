@@ -0,0 +1,232 @@
+"""Load test of the agent graph without network access.
+
+The chat and embedding models are replaced by the stubs of benchmarks.stubs, the timetable is a SQLite database
+seeded from the cinema fixtures (dates shifted to start today) and filled up to a realistic size with generated
+showtimes, by default about 6000 over 40 titles, 12 cinemas and a week. The movie details are synthetic documents
+in a temporary Chroma collection. Concurrent sessions ask the questions of the corpus in turn.
+
+    python -m benchmarks.load_test                                  # 8 sessions of 5 questions
+    python -m benchmarks.load_test --titles 80 --cinemas 20 --days 14 # a larger timetable
+    python -m benchmarks.load_test --sessions 50 --turns 10 --llm-latency 0.5
+    python -m benchmarks.load_test --no-cache                       # every question reaches the tools
+    python -m benchmarks.load_test --outage                         # and then answer with the database removed
+"""
+
+import os, sys, time, random, shutil, asyncio, argparse, tempfile, resource, tracemalloc
+from datetime import date, time as dt_time, timedelta
+from pathlib import Path
+from benchmarks.parse_benchmark import fixture_path
+
+QUESTIONS = Path(__file__).parent / 'fixtures' / 'questions.txt'
+DB_TABLE = 'timetable'
+GENRES = ['Drama', 'Comedy', 'Horror', 'Animation', 'Science Fiction', 'Thriller']
+PEOPLE = ['Christopher Nolan', 'Greta Gerwig', 'Paolo Sorrentino', 'Tom Hanks', 'Zendaya', 'Toni Servillo', 'Alba Rohrwacher']
+CINEMAS = ['Cinema America', 'Cinema Ariston', 'Cinema Cappuccini', 'Cinema Nickelodeon', 'Cinema Odeon', 'Cinema Ritz',
+           'Cineclub Fillmore', 'Cinema Lux', 'Cinema Instabile', 'Cinema Verdi', 'Cinema Paradiso', 'Cinema Excelsior']
+WORDS = ['notte', 'mare', 'giardino', 'viaggio', 'segreto', 'estate', 'fuoco', 'città', 'silenzio', 'ritorno', 'vento', 'ombra',
+         'cuore', 'strada', 'isola', 'inverno']
+LANGUAGES = ['it'] * 8 + ['en'] * 3 + ['jp', 'kor']
+
+
+def configure(workdir: Path, args):
+    """Point every store of the bot to the work directory and every model to the stubs, before they are imported."""
+
+    os.environ.update({
+        'DB_TABLE': DB_TABLE,
+        'DB_URL': f'sqlite:///{workdir / "timetable.sqlite"}',
+        'MISTRALAI_API_KEY': 'stub',
+        'EMBEDDING_BACKEND': 'benchmarks.stubs:StubEmbeddings',
+        'EMBEDDING_CACHE_PATH': str(workdir / 'embedding_cache.sqlite'),
+        'CHROMA_DIR': str(workdir / 'chroma'),
+        'CHROMA_COLLECTION': 'bench',
+        'CHECKPOINT_URL': f'sqlite:///{workdir / "checkpoints.sqlite"}',
+        'ANSWER_CACHE_BACKEND': 'memory',
+        'METRICS_LOG': str(workdir / 'metrics.jsonl'),
+        'METRICS_PORT': '0',
+        'LLM_RATE_LIMIT': '1000000', # the stub has no rate limit, only latency
+        'LLM_BURST': '1000000',
+        'LLM_MAX_CONCURRENCY': str(max(4, args.sessions * 2)),
+        'BENCH_LLM_LATENCY': str(args.llm_latency),
+        'BENCH_EMBED_LATENCY': str(args.embed_latency),
+        })
+    if args.no_cache:
+        os.environ['ANSWER_CACHE_TTL'] = '0'
+
+def expand_timetable(records: list[dict], titles: int, cinemas: int, days: int, seed=0) -> list[dict]:
+    """The parsed records with generated showtimes added up to the number of titles, cinemas and days:
+    every cinema shows about half of the titles, two to five times a day."""
+
+    rng = random.Random(seed)
+    names = list(dict.fromkeys(record['title'] for record in records))
+    while len(names) < titles:
+        name = ' '.join(rng.sample(WORDS, 2))
+        if name not in names:
+            names.append(name)
+    venues = list(dict.fromkeys(record['cinema'] for record in records))
+    venues += [name for name in CINEMAS if name not in venues][:max(0, cinemas - len(venues))]
+    rows = list(records)
+    for cinema in venues:
+        for title in rng.sample(names, max(1, len(names) // 2)):
+            language, link = rng.choice(LANGUAGES), f'https://example.com/{title.replace(" ", "-")}'
+            for day in range(days):
+                starts = sorted(rng.sample(range(14 * 4, 23 * 4), rng.randint(2, 5))) # quarter hours from 14:00
+                rows += [{'cinema': cinema, 'title': title, 'language': language, 'link': link,
+                          'date': date.today() + timedelta(days=day), 'time': dt_time(start // 4, start % 4 * 15)}
+                         for start in starts]
+    return rows
+
+def build_timetable(titles=40, cinemas=12, days=7) -> list[str]:
+    """Parse the cinema fixtures, fill them up to a realistic timetable in SQLite and return the titles."""
+
+    from database.crawl import Database
+    from database.scrapers import SCRAPERS, load_plugins, make_soup
+
+    load_plugins()
+    records = []
+    for name, scraper in SCRAPERS.items():
+        if fixture_path(name).exists():
+            scraper = scraper()
+            records += scraper.normalize(scraper.parse(make_soup(fixture_path(name).read_text(encoding='utf-8'))))
+    if not records:
+        sys.exit('No cinema fixtures, save them with python -m benchmarks.parse_benchmark --save')
+
+    shift = date.today() - min(record['date'] for record in records)
+    rows = expand_timetable([dict(record, date=record['date'] + shift) for record in records], titles, cinemas, days)
+
+    database = Database()
+    database.timetable = rows
+    database.insert_timetable_data(mode='replace') # in the schema of TIMETABLE_SCHEMA
+    print(f"timetable   {len(rows)} showtimes of {len({row['title'] for row in rows})} titles "
+          f"in {len({row['cinema'] for row in rows})} cinemas over {days} days")
+    return sorted({row['title'] for row in rows})
+
+def build_vectorstore(titles: list[str]):
+    """Synthetic TMDB documents of the titles, with the metadata used by the retriever."""
+
+    from langchain_core.documents import Document
+    from database.vectorstore import vectordb
+    from database.tmdb_movies import hash_title
+
+    docs = []
+    for i, title in enumerate(titles):
+        metadata = {'source': 'TMDB', 'sql_db_title': title, 'tmdb_id': i, 'title': title.title(), 'original_title': title.title(),
+                    'director': PEOPLE[i % len(PEOPLE)], 'cast': ', '.join(PEOPLE[(i + 1) % len(PEOPLE):][:3]),
+                    'genres': ', '.join(GENRES[i % len(GENRES):][:2]), 'runtime': 90 + i % 60, 'year': 2025, 'rating': 5 + i % 5}
+        docs.append(Document(page_content=f"{title.title()}\n\nA {metadata['genres'].lower()} movie directed by {metadata['director']}.",
+                             metadata={**metadata, 'type': 'description'}, id=hash_title(title + 'd')))
+        docs.append(Document(page_content=f"Title: {title.title()}\nDirector: {metadata['director']}\nCast: {metadata['cast']}\n"
+                                          f"Genres: {metadata['genres']}\nDuration: {metadata['runtime']} minutes",
+                             metadata={**metadata, 'type': 'info'}, id=hash_title(title + 'i')))
+    vectordb.add_documents(docs, ids=[doc.id for doc in docs])
+
+def load_app():
+    """The compiled graph with the stub chat model in place of Mistral."""
+
+    import LLM.llm, LLM.agent
+    from LLM.metrics import TokenCallback
+    from benchmarks.stubs import StubChatModel
+
+    stub = StubChatModel(callbacks=[TokenCallback()])
+    LLM.llm.llm = LLM.agent.llm = stub
+    LLM.agent.summary_llm = stub.with_config(run_name='summary', tags=['summary'])
+    LLM.llm.llm_with_tools = LLM.agent.llm_with_tools = stub.bind_tools(LLM.llm.tools)
+    LLM.llm.llm_without_tools = LLM.agent.llm_without_tools = stub.bind_tools(LLM.llm.tools, tool_choice="none")
+    return LLM.agent
+
+
+async def session(agent, number, questions, turns, latencies):
+    config = {"configurable": {"thread_id": f'bench-{number}'}}
+    for turn in range(turns):
+        question = questions[(number * turns + turn) % len(questions)]
+        start = time.perf_counter()
+        await agent.app.ainvoke({"messages": [("human", question)]}, config=config)
+        latencies.append(time.perf_counter() - start)
+        if agent.SUMMARY_MODE == 'rolling': # as the bot does once the reply is sent
+            await agent.asummarize(config)
+
+async def run_sessions(agent, questions, sessions, turns):
+    latencies = []
+    await asyncio.gather(*(session(agent, number, questions, turns, latencies) for number in range(sessions)))
+    return latencies
+
+
+def check_outage(workdir: Path, titles: list[str]):
+    """Remove the timetable database and check that the showtime templates are still answered from the snapshot."""
+
+    import LLM.llm
+
+    LLM.llm.timetable_snapshot.refresh(force=True)
+    (workdir / 'timetable.sqlite').unlink()
+    LLM.llm.engine.dispose()
+    LLM.llm.table_info_cache.checked_at = LLM.llm.timetable_snapshot.checked_at = 0.0 # check the database again
+    failed = []
+    for title in titles:
+        state = {'question': f'when is {title} playing?', 'query': '', 'result': '', 'answer': ''}
+        try:
+            result = LLM.llm.find_showtimes.invoke({'state': state})['result']
+        except Exception as e:
+            result = f'Error: {e!r}'
+        if title not in result or result.startswith('Error:'):
+            failed.append(f'{title}: {result[:200]}')
+    print(f"outage      {len(titles) - len(failed)}/{len(titles)} showtime questions answered without the database")
+    if failed:
+        sys.exit('\n'.join(failed))
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--turns', type=int, default=5)
+    parser.add_argument('--llm-latency', type=float, default=0.2)
+    parser.add_argument('--embed-latency', type=float, default=0.01)
+    parser.add_argument('--questions', type=Path, default=QUESTIONS)
+    parser.add_argument('--titles', type=int, default=40, help='titles of the timetable')
+    parser.add_argument('--cinemas', type=int, default=12, help='cinemas of the timetable')
+    parser.add_argument('--days', type=int, default=7, help='days of showtimes from today')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--outage', action='store_true', help='remove the database at the end and check the snapshot answers')
+    parser.add_argument('--trace-memory', action='store_true', help='peak Python allocations with tracemalloc, slows the run down')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory with the databases and the metrics log')
+    args = parser.parse_args()
+
+    questions = [line.strip() for line in args.questions.read_text(encoding='utf-8').splitlines() if line.strip()]
+    workdir = Path(tempfile.mkdtemp(prefix='bench_'))
+    configure(workdir, args)
+    try:
+        titles = build_timetable(args.titles, args.cinemas, args.days)
+        build_vectorstore(titles)
+        agent = load_app()
+
+        if args.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        latencies = asyncio.run(run_sessions(agent, questions, args.sessions, args.turns))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+        tracemalloc.stop()
+
+        print(f"{args.sessions} sessions x {args.turns} turns, {len(titles)} titles, "
+              f"LLM latency {args.llm_latency * 1000:.0f} ms, embedding latency {args.embed_latency * 1000:.0f} ms")
+        print(f"throughput  {len(latencies) / elapsed:.2f} turns/s over {elapsed:.1f} s")
+        print(f"latency     p50 {percentile(latencies, 0.5) * 1000:.0f} ms, p95 {percentile(latencies, 0.95) * 1000:.0f} ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.0f} ms, max {max(latencies) * 1000:.0f} ms")
+        traced = f"peak traced {peak / 2**20:.1f} MB, " if peak is not None else ''
+        print(f"memory      {traced}max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+        print()
+        from LLM.metrics import report
+        report(os.environ['METRICS_LOG'])
+        if args.outage:
+            print()
+            check_outage(workdir, titles)
+    finally:
+        if args.keep:
+            print(f'\nwork directory: {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
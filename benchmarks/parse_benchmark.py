@@ -0,0 +1,94 @@
+"""CPU time and memory of the cinema scrapers over the HTML pages in benchmarks/fixtures.
+
+The committed fixtures are synthetic mockups of a few KB with only the markup the scrapers select, enough to check
+the parsers and to seed the load test; timings measured on them say nothing about the real pages. Save the live
+pages first to compare the parsers:
+
+    python -m benchmarks.parse_benchmark --save                # replace the fixtures with the live pages
+    python -m benchmarks.parse_benchmark                       # parse the fixtures with every parser
+    python -m benchmarks.parse_benchmark --scale 20 --repeat 10 # simulate pages 20 times larger
+"""
+
+import argparse, re, statistics, time, tracemalloc
+from pathlib import Path
+from database.scrapers import SCRAPERS, load_plugins, make_soup
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+SYNTHETIC = 'synthetic mockup' # marker of the committed fixtures, absent from the pages saved with --save
+PARSERS = ['html.parser', 'lxml']
+
+
+def fixture_path(name):
+    return FIXTURES / f'{name.lower()}.html'
+
+def save_fixtures():
+    """Download the current pages of all cinemas into the fixtures."""
+
+    for name, scraper in SCRAPERS.items():
+        soup = scraper().fetch()
+        if soup is None:
+            print(f'{name}: not available')
+            continue
+        fixture_path(name).write_text(str(soup), encoding='utf-8')
+        print(f'{name}: saved {fixture_path(name)}')
+
+def scale_markup(markup, scale):
+    """Repeat the body of the page to simulate a larger timetable."""
+
+    match = re.search(r'(<body[^>]*>)(.*)(</body>)', markup, re.DOTALL)
+    if scale <= 1 or not match:
+        return markup
+    return markup[:match.start(2)] + match.group(2) * scale + markup[match.end(2):]
+
+def parse_page(scraper, markup, parser):
+    return scraper.normalize(scraper.parse(make_soup(markup, parser)))
+
+def benchmark(name, markup, parser, repeat):
+    scraper = SCRAPERS[name]()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        records = parse_page(scraper, markup, parser)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    parse_page(scraper, markup, parser)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    return {'records': len(records),
+            'mean_ms': statistics.mean(timings),
+            'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            'peak_kb': peak / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--parsers', nargs='+', default=PARSERS)
+    parser.add_argument('--save', action='store_true')
+    args = parser.parse_args()
+
+    load_plugins()
+    if args.save:
+        save_fixtures()
+        return
+
+    print(f"{'cinema':<10} {'parser':<12} {'KB':>8} {'records':>8} {'mean ms':>9} {'p95 ms':>9} {'peak KB':>9}")
+    for name in SCRAPERS:
+        if not fixture_path(name).exists():
+            print(f'{name}: no fixture')
+            continue
+        markup = scale_markup(fixture_path(name).read_text(encoding='utf-8'), args.scale)
+        if SYNTHETIC in markup[:500]:
+            print(f'{name}: synthetic fixture, not representative of the real page')
+        for html_parser in args.parsers:
+            result = benchmark(name, markup, html_parser, args.repeat)
+            print(f"{name:<10} {html_parser:<12} {len(markup) / 1024:>8.1f} {result['records']:>8} "
+                  f"{result['mean_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['peak_kb']:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Deterministic stand-ins for the Mistral chat and embedding models, with configurable latency."""
+
+import os, re, json, time, zlib, asyncio, hashlib
+from typing import Any, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableLambda
+
+BENCH_LLM_LATENCY = float(os.getenv('BENCH_LLM_LATENCY', 0.2)) # seconds per chat model call
+BENCH_EMBED_LATENCY = float(os.getenv('BENCH_EMBED_LATENCY', 0.01)) # seconds per embedding request
+BENCH_EMBED_DIM = 256
+
+DATE_WORDS = re.compile(r"\b(today|tonight|tomorrow|weekend|next|this|oggi|stasera|domani|dopodomani|fine settimana|prossim\w+|questo)\b", re.IGNORECASE)
+MOVIE_WORDS = re.compile(r"\b(about|plot|directed|director|starring|actor|cast|genre|rating|long|trama|regista|diretto|attor\w+|genere|durata|comedy|commedia|horror|drama)\b", re.IGNORECASE)
+SHOWTIME_WORDS = re.compile(r"\b(when|where|playing|showtimes?|schedule|orari\w*|programm\w+|proiezion\w+|danno|dove)\b", re.IGNORECASE)
+SMALL_TALK = re.compile(r"^(hi|hello|ciao|thanks|thank you|grazie|ok)\b", re.IGNORECASE)
+
+
+def tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class StubChatModel(BaseChatModel):
+    """Chat model answering like the agent would: call the matching tools once (movie details and showtimes together
+    when both are asked, dates resolved first for movie details), then reply with the start of the tool output.
+    Summaries, date rewrites and SQL are canned."""
+
+    latency: float = BENCH_LLM_LATENCY
+    tool_names: list[str] = []
+    tool_choice: Optional[str] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return 'stub'
+
+    def bind_tools(self, tools, **kwargs):
+        return self.model_copy(update={'tool_names': [getattr(tool, 'name', None) or tool.__name__ for tool in tools],
+                                       'tool_choice': kwargs.get('tool_choice')})
+
+    def with_structured_output(self, schema, **kwargs):
+        table = os.getenv('DB_TABLE')
+
+        def generate(prompt):
+            time.sleep(self.latency)
+            return schema(query=f"SELECT cinema, title, language, date, time, link FROM {table} ORDER BY date, time LIMIT 10")
+
+        async def agenerate(prompt):
+            await asyncio.sleep(self.latency)
+            return schema(query=f"SELECT cinema, title, language, date, time, link FROM {table} ORDER BY date, time LIMIT 10")
+
+        return RunnableLambda(generate, afunc=agenerate)
+
+    def respond(self, messages: list[BaseMessage]) -> AIMessage:
+        text = str(messages[-1].content)
+        if not self.tool_names:
+            match = re.search(r'### Input:\s*(.*?)\s*### Output', text, re.DOTALL) # relative dates prompt
+            content = match.group(1) if match else f'Summary: {text[:200]}'
+            return self.message(content, messages)
+
+        start = max(i for i, message in enumerate(messages) if message.type == 'human')
+        question = str(messages[start].content)
+        called = {message.name: message.content for message in messages[start + 1:] if message.type == 'tool'}
+        if SMALL_TALK.search(question):
+            return self.message('Hello! Ask me about the movies playing in Genova.', messages)
+        found = '\n'.join(str(result)[:500] for result in called.values())
+        if self.tool_choice == 'none':
+            return self.message(f"Here is what I found so far:\n{found}", messages)
+
+        wanted = ['retrieve_movie_info'] if MOVIE_WORDS.search(question) else []
+        if not wanted or SHOWTIME_WORDS.search(question):
+            wanted.append('find_showtimes')
+        if 'retrieve_movie_info' in wanted and DATE_WORDS.search(question) and 'date_tool' not in called: # dates of movie questions
+            return self.call(['date_tool'], question, messages)
+        if 'date_tool' in called:
+            try:
+                question = json.loads(called['date_tool'])['question']
+            except (ValueError, KeyError, TypeError):
+                pass
+        pending = [tool for tool in wanted if tool in self.tool_names and tool not in called]
+        if pending:
+            return self.call(pending, question, messages)
+        return self.message(f"Here is what I found:\n{found}", messages)
+
+    def call(self, tools, question, messages):
+        """One step calling the tools together, as the model does for independent questions."""
+
+        state = {'question': question, 'query': '', 'result': '', 'answer': ''}
+        calls = [{'name': tool, 'args': {'state': state},
+                  'id': 'call_' + hashlib.sha1(f'{len(messages)}{tool}{question}'.encode()).hexdigest()[:9]} for tool in tools]
+        return self.message('', messages, tool_calls=calls)
+
+    @staticmethod
+    def message(content, messages, **kwargs):
+        input_tokens = sum(tokens(str(message.content)) for message in messages)
+        output_tokens = tokens(content)
+        return AIMessage(content=content, usage_metadata={'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                                                          'total_tokens': input_tokens + output_tokens}, **kwargs)
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager: Any = None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self.respond(messages))])
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager: Any = None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=self.respond(messages))])
+
+
+class StubEmbeddings(Embeddings):
+    """Hashed bag-of-words vectors: deterministic, and texts sharing words are similar."""
+
+    def __init__(self, latency=BENCH_EMBED_LATENCY, dim=BENCH_EMBED_DIM):
+        self.latency = latency
+        self.dim = dim
+
+    def vector(self, text: str) -> list[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r'\w+', text.lower()):
+            vector[zlib.crc32(word.encode()) % self.dim] += 1
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency)
+        return [self.vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(self.latency)
+        return self.vector(text)
@@ -1,36 +1,22 @@
-import re, requests, csv, os
-from datetime import datetime
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
-from sqlalchemy import create_engine, Column, String, Date, Time, Integer
+import csv, os, threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, time as dt_time, timedelta
+from time import monotonic
+from sqlalchemy import Column, String, Date, Time, Integer
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Table, MetaData
+from sqlalchemy import Table, MetaData, select, bindparam
+from database.extract import generation_table, bump_generation, get_db_engine
+from database.normalized import NormalizedTimetable, TIMETABLE_SCHEMA
+from database.scrapers import SCRAPERS, DRIVER_POOL, CRAWL_WORKERS, REQUEST_TIMEOUT, clean_title, load_plugins
 
-chrome_options = Options()
-chrome_options.add_argument("--headless")
-DRIVER = webdriver.Chrome(options=chrome_options)
+TIMETABLE_SYNC_MODE = os.getenv('TIMETABLE_SYNC_MODE', 'sync') # sync: apply only the differences, replace: rewrite the table
 
-AVAILABLE_CINEMAS = {
-    'UCI': 'https://www.ucicinemas.it/cinema/liguria/genova/uci-cinemas-fiumara-genova/',
-    'TheSpace': 'https://www.thespacecinema.it/al-cinema/genova',
-    'Circuito': 'https://circuitocinemagenova.com/programmazione-settimanale/'}
-HEADERS = {'User-Agent': 'Mozilla/5.0 (iPad; CPU OS 12_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148'}
+AVAILABLE_CINEMAS = {name: scraper.url for name, scraper in load_plugins().items()}
 
 Base = declarative_base()
 
 DB_TABLE = os.getenv('DB_TABLE')
 
-db_config = {
-    'host': os.getenv('DB_HOST'), 
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD'),
-    'database': os.getenv('DB_NAME')
-}
-
 class Timetable(Base):
     __tablename__ = DB_TABLE
 
@@ -42,210 +28,115 @@ class Timetable(Base):
     date = Column(Date, nullable=True)
     time = Column(Time, nullable=True)
 
+class FlatTimetable():
+    """Writes of the crawler into the single timetable table."""
+
+    def __init__(self, engine):
+        Base.metadata.create_all(engine)
+        self.table = Table(DB_TABLE, MetaData(), autoload_with=engine)
+
+    def delete_all(self, connection):
+        return connection.execute(self.table.delete()).rowcount
+
+    def delete_cinemas(self, connection, cinemas, before):
+        """Delete the showtimes of the cinemas and the ones of any cinema before the date."""
+
+        return connection.execute(self.table.delete().where(self.table.c.cinema.in_(cinemas) | (self.table.c.date < before))).rowcount
+
+    def delete(self, connection, ids):
+        connection.execute(self.table.delete().where(self.table.c.id.in_(ids)))
+
+    def prune(self, connection):
+        pass # nothing but showtimes in the flat table
+
+    def update_links(self, connection, updates):
+        """Store the new links, given (row id, crawled record) pairs."""
+
+        connection.execute(self.table.update().where(self.table.c.id == bindparam('row_id')).values(link=bindparam('new_link')),
+                           [{'row_id': row_id, 'new_link': record['link']} for row_id, record in updates])
+
+    def insert(self, connection, records):
+        connection.execute(self.table.insert(), records)
+
+
 class Database():
     def __init__(self):
         self.timetable = []
+        self.stats = {} # per scraper success, attempts, failures, records and duration of the last crawl
 
     def clean_title(self, title):
         """Clean the movie title."""
 
-        title = title.lower()
-        if title.endswith('autism friendly'):
-            title = title[:-16]
-        elif title.endswith('al cinema con te'):
-            title = title[:-19]
-        elif title.endswith('evento contro il bullismo'):
-            title = title[:-26]
-        title = re.sub(r'[\:\-–]', '', title)
-        title = re.sub(r'\s{2,}', ' ', title)
-        title = re.sub(r'\s+\([12][09][0-9][0-9]\)', '', title)
-        return title.strip()
-
-    def respond(self, cinema: str, href=None):
-        """Send a request to the cinema website and return the response."""
-
-        if href:
-            url = href
-        else:
-            url = AVAILABLE_CINEMAS[cinema]
-        if cinema == 'TheSpace':
-            DRIVER.get(url)
-            try:
-                element = WebDriverWait(DRIVER, 5).until(EC.presence_of_element_located((By.ID, "filmlist__data")))
-            except:
-                print("Loading timed out.")
-                return None
-            finally:
-                page_source = DRIVER.page_source
-                soup = BeautifulSoup(page_source, 'html.parser')
-                return soup
-        else:
-            response = requests.get(url, headers=HEADERS)
-            if response.status_code == 200:
-                soup = BeautifulSoup(response.content, 'html.parser')
-                return soup
+        return clean_title(title)
+
+    def run_scraper(self, name):
+        """Run a single scraper in isolation, with its own timeout and retries, and return its records.
+        An attempt without records counts as failed; stats[name]['ok'] tells whether the scraper succeeded in the end.
+        Attempts run in daemon threads, so a hung one can't block the exit; its browser is quit on timeout."""
+
+        scraper = SCRAPERS[name]()
+        stats = self.stats[name] = {'ok': False, 'attempts': 0, 'failures': 0, 'records': 0, 'error': None, 'seconds': 0.0}
+        start = monotonic()
+        print(f'Crawling {name}...')
+        records = []
+        for attempt in range(scraper.retries + 1):
+            stats['attempts'] += 1
+            result = {}
+            thread = threading.Thread(target=self.attempt, args=(scraper, result), name=f'scraper-{name}', daemon=True)
+            thread.start()
+            thread.join(scraper.timeout)
+            if thread.is_alive():
+                stats['error'] = f'timed out after {scraper.timeout} seconds'
+                DRIVER_POOL.abort(thread.ident) # its browser calls fail at once instead of overlapping the retry
+                thread.join(REQUEST_TIMEOUT)
+            elif 'error' in result:
+                stats['error'] = repr(result['error'])
+            elif result['records']:
+                records = result['records']
+                break
             else:
-                print(f"Failed to retrieve the webpage. Status code: {response.status_code}")
-                return None
-
-    def timetable_UCI(self):
-        """Crawl timetable data from UCI Cinemas website."""
-
-        soup = self.respond('UCI')
-        if soup:
-
-            dates = soup.select('#showtimes-venue-container > header > div > ul > li > a')
-            dates = [date['data-day'] for date in dates]
-
-            data = []
-            for date in dates:
-                movies = soup.select(f'#movie_{date} > div.showtimes__show')
-
-                date = [date[i:i+2] for i in range(0, len(date), 2)]
-                date = f"20{date[2]}-{date[1]}-{date[0]}"
-
-                for movie in movies:
-                    titles = movie.select('span.movie-name > a')
-                    showtimes = movie.select('ul.showtimes__movie__shows > li > a')
-                    showtimes = [showtime.get_text() + ":00" for showtime in showtimes]
-                    for title in titles:
-                        name = title.get_text().lower()
-                        if name.startswith('(o.v.)'):
-                            name = name[7:]
-                            language = 'en'
-                        elif name.startswith('(jp)'):
-                            name = name[5:]
-                            language = 'jp'
-                        elif name.startswith('(kor)'):
-                            name = name[6:]
-                            language = 'kor'
-                        else:
-                            language = 'it'
-                        href = 'https://www.ucicinemas.it' + title['href']
-                        
-                        updated = False
-                        for movie in data:
-                            if movie['title'] == name and movie['language'] == language:
-                                if date in movie['dates']:
-                                    movie['dates'][date] += showtimes
-                                else:
-                                    movie['dates'][date] = showtimes
-                                updated = True
-                                break
-                        if not updated:
-                            
-                            record = {"cinema": 'UCI Fiumara', 'title': self.clean_title(name), 'language': language, 'dates': {date: showtimes}, 'link': href}
-                            data.append(record)
-            
-            for record in data:
-                for date in record['dates']:
-                    self.timetable += [{"cinema": record["cinema"], 
-                                        "title": record['title'], 
-                                        "language": record['language'], 
-                                        "link": record['link'], 
-                                        "date": date, 
-                                        "time": time} for time in record['dates'][date]]
-            return True
- 
-    def timetable_the_space(self):
-        """Crawl timetable data from TheSpace Cinema website."""
-        
-        def process_time(time_evement):
-            date = time_evement.get('datetime')
-            time = time_evement.get_text() + ":00"
-            return (date, time)
-
-        soup = self.respond('TheSpace')
-        if soup:
-            movies = soup.select('#filmlist__data > div.filmlist__item') 
-            movies = [movie for movie in movies if movie.get('data-hidden') == 'false']
-            data = []
-            for movie in movies:
-                title = movie.select('div.filmlist__info > div > a > span')[0].get_text().lower()
-                if title.endswith('versione originale'):
-                    title = title[:-21]
-                    language = 'en'
-                else:
-                    language = 'it'
-                
-                href = 'https://www.thespacecinema.it' + movie.select('div.filmlist__info > div > a')[0].get('href')
-                
-                timetable = movie.select('div.day')
-                date = [item.select('time.date') for item in timetable]
-                time = [item.select('time.default') for item in timetable]
-                for day in time:
-                    for timeslot in day:
-                        (date, time) = process_time(timeslot)
-                        
-                        self.timetable += [{
-                            'cinema': 'TheSpace', 
-                            'title': self.clean_title(title), 
-                            'language': language, 
-                            'link': href, 
-                            'date': date, 
-                            'time': time}]
+                stats['error'] = 'no records parsed' # a changed or half-loaded page, not an empty timetable
+            stats['failures'] += 1
+            print(f"Error while crawling {name} (attempt {attempt + 1}): {stats['error']}")
+        stats['ok'] = bool(records)
+        stats['records'] = len(records)
+        stats['seconds'] = round(monotonic() - start, 2)
+        return records
+
+    @staticmethod
+    def attempt(scraper, result):
+        try:
+            result['records'] = scraper.run()
+        except Exception as e:
+            result['error'] = e
+
+    def crawl_timetable(self, concurrent=True, cinemas=None):
+        """Crawl timetable data from all cinema websites, concurrently unless stated otherwise."""
+
+        cinemas = cinemas or list(SCRAPERS)
+        try:
+            if concurrent:
+                with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as executor:
+                    results = list(executor.map(self.run_scraper, cinemas))
+            else:
+                results = [self.run_scraper(cinema) for cinema in cinemas]
+        finally:
+            DRIVER_POOL.close() # browsers hold hundreds of MB, don't keep them between crawls
+
+        for name in cinemas:
+            print(f"{name}: {self.stats[name]['records']} records in {self.stats[name]['seconds']}s, "
+                  f"{self.stats[name]['failures']} failed attempts" + ('' if self.stats[name]['ok'] else ', FAILED'))
+        self.timetable = [record for records in results for record in records]
+        return self.timetable
 
-            return True
+    def crawled(self, cinema) -> bool:
+        """Whether the cinema was crawled successfully, so that its stored showtimes can be replaced.
+        Without a crawl, for a timetable given by hand, every cinema is, as are those no scraper covers any more."""
 
-    def timetable_circuito(self):
-        """Crawl timetable data from Circuito Cinema Genova website."""
-
-        soup = self.respond('Circuito')
-        if soup:
-            cinemas = soup.select('div.cinema_row')
-            for cinema in cinemas:
-                name = cinema.select('h2')[0].get_text()
-                films = cinema.select('div.single-film')
-                for film in films:
-                    title = film.select('p')[0].get_text().lower().strip()
-                    if title.endswith('- v. o.'):
-                        title = title[:-8]
-                        language = 'en'
-                    elif title.endswith('- vers.orig.sott.it'):
-                        title = title[:-20]
-                        language = 'en'
-                    elif title.endswith('vers. orig. sott.'):
-                        title = title[:-18]
-                        language = 'en'
-                    else:
-                        language = 'it'
-                    days = film.select('div.day_block')
-                    if not days:
-                        continue
-                    else:
-                        href = film.select('a.theme-btn')[0].get('href')
-                        data = {}
-                        for day in days:
-                            date = day.select('h4')[0].get_text().split(' ')
-                            today_year = datetime.now().year
-                            month_mapping = {'Gennaio': '01', 'Febbraio': '02', 'Marzo': '03', 'Aprile': '04', 'Maggio': '05', 'Giugno': '06', 'Luglio': '07', 'Agosto': '08', 'Settembre': '09', 'Ottobre': '10', 'Novembre': '11', 'Dicembre': '12'}
-                            date = f'{today_year}-{month_mapping[date[-1]]}-{date[1]}'
-                            hours = day.select('span.start_hour')
-                            hours = [hour.get_text().strip() + ':00' for hour in hours]
-                            data[date] = hours
-                            for time in hours:
-                                self.timetable += [{
-                                    'cinema': 'Circuito ' + name, 
-                                    'title': self.clean_title(title), 
-                                    'language': language, 
-                                    'link': href, 
-                                    'date': date, 
-                                    'time': time}]
+        if not self.stats:
             return True
-
-    def crawl_timetable(self):
-        """Crawl timetable data from all cinema websites."""
-
-        for cinema in AVAILABLE_CINEMAS:
-            print(f'Crawling {cinema}...')
-            if cinema == 'UCI':
-                self.timetable_UCI()
-            if cinema == 'Circuito':
-                self.timetable_circuito()
-            if cinema == 'TheSpace':
-                self.timetable_the_space()
-
-        return self.timetable
+        names = [name for name, scraper in SCRAPERS.items() if scraper.covers(cinema)]
+        return not names or any(self.stats.get(name, {}).get('ok') for name in names)
 
     def write_timetable_to_csv(self, filename='timetable.csv'):
         """Write timetable data to a CSV file."""
@@ -257,31 +148,85 @@ class Database():
             cw.writerows(self.timetable)
         return True
     
-    def insert_timetable_data(self):
-        """Insert timetable data into the database."""
+    @staticmethod
+    def showtime_key(record):
+        """Identify a showtime by (cinema, title, language, date, time) whatever the types returned by the driver."""
+
+        day, time = record['date'], record['time']
+        if isinstance(day, date):
+            day = day.isoformat()
+        if isinstance(time, timedelta): # MySQL TIME columns are returned as timedelta
+            time = (datetime.min + time).time()
+        if isinstance(time, dt_time):
+            time = time.strftime('%H:%M:%S')
+        elif time and len(time) == 7:
+            time = '0' + time
+        return (record['cinema'], record['title'], record['language'], day, time)
+
+    def insert_timetable_data(self, mode=TIMETABLE_SYNC_MODE, schema=TIMETABLE_SCHEMA):
+        """Write timetable data into the database within a single transaction and return the counts of changed rows.
+        In sync mode only new showtimes are inserted and vanished or past ones deleted, otherwise all rows are replaced.
+        Either way the showtimes of a cinema whose scraper failed are kept, apart from the past ones.
+        The normalized schema is created, and the flat table migrated to it, on the first run."""
+
+        engine = get_db_engine()
+        generation_table.create(engine, checkfirst=True)
+        store = NormalizedTimetable(engine) if schema == 'normalized' else FlatTimetable(engine)
+        today = date.today().isoformat()
+        if mode != 'replace' and 'id' not in store.table.c: # e.g. a flat table created by pandas, rows can't be told apart
+            print(f"{DB_TABLE} has no id column, replacing the timetable instead of syncing it.")
+            mode = 'replace'
+
+        with engine.begin() as connection:
+            if mode == 'replace':
+                counts = self.replace_timetable(connection, store, today)
+            else:
+                counts = self.sync_timetable(connection, store, today)
+            store.prune(connection)
+            if counts['inserted'] or counts['deleted'] or counts['updated']:
+                bump_generation(connection)
 
-        engine = create_engine(f"mysql+pymysql://{db_config['user']}:{db_config['password']}@{db_config['host']}/{db_config['database']}")
-        Base.metadata.create_all(engine)
-        metadata = MetaData()
-        timetable_ = Table(DB_TABLE, metadata, autoload_with=engine)
-
-        with engine.connect() as connection:
-            transaction = connection.begin()  # Start transaction
-            try:
-                connection.execute(timetable_.delete())  # Delete all rows
-                transaction.commit()  # Commit changes
-                print("All records deleted successfully.")
-            except Exception as e:
-                transaction.rollback()  # Rollback on error
-                print(f"Error: {e}")
-        connection.close()
-
-        with engine.connect() as connection:
-            trans = connection.begin()
-            connection.execute(timetable_.insert(), self.timetable)
-            trans.commit()
-        connection.close()    
-        return True
+        print(f"Timetable {mode}: {counts['inserted']} inserted, {counts['deleted']} deleted, "
+              f"{counts['updated']} updated, {counts['unchanged']} unchanged.")
+        return counts
+
+    def replace_timetable(self, connection, store, today):
+        """Replace the stored showtimes of the crawled cinemas with the crawled ones."""
+
+        if all(self.stats.get(name, {}).get('ok') for name in SCRAPERS) or not self.stats:
+            deleted = store.delete_all(connection)
+        else:
+            cinemas = connection.execute(select(store.table.c.cinema).distinct()).scalars()
+            deleted = store.delete_cinemas(connection, [cinema for cinema in cinemas if self.crawled(cinema)], date.fromisoformat(today))
+        if self.timetable:
+            store.insert(connection, self.timetable)
+        return {'inserted': len(self.timetable), 'deleted': deleted, 'updated': 0, 'unchanged': 0}
+
+    def sync_timetable(self, connection, store, today, batch_size=500):
+        """Apply the difference between the crawled and the stored showtimes."""
+
+        crawled = {self.showtime_key(record): record for record in self.timetable}
+        stored = {}
+        to_delete, to_update = [], []
+        timetable_ = store.table
+        columns = [timetable_.c.id, timetable_.c.cinema, timetable_.c.title, timetable_.c.language, timetable_.c.link, timetable_.c.date, timetable_.c.time]
+        for row in connection.execute(select(*columns)).mappings():
+            key = self.showtime_key(row)
+            if (key[3] or '') < today or key in stored or (key not in crawled and self.crawled(key[0])):
+                to_delete.append(row['id'])
+                continue
+            stored[key] = row # kept as it is if its cinema failed
+            if key in crawled and crawled[key]['link'] != row['link']:
+                to_update.append((row['id'], crawled[key]))
+        to_insert = [record for key, record in crawled.items() if key not in stored and key[3] >= today]
+
+        for i in range(0, len(to_delete), batch_size):
+            store.delete(connection, to_delete[i:i+batch_size])
+        if to_update:
+            store.update_links(connection, to_update)
+        if to_insert:
+            store.insert(connection, to_insert)
+        return {'inserted': len(to_insert), 'deleted': len(to_delete), 'updated': len(to_update), 'unchanged': len(stored) - len(to_update)}
     
 
 def run(event, context):
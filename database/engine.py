@@ -0,0 +1,70 @@
+import os, threading
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+db_config = {
+    'host': os.getenv('DB_HOST'),
+    'user': os.getenv('DB_USER'),
+    'password': os.getenv('DB_PASSWORD'),
+    'database': os.getenv('DB_NAME')
+}
+
+DB_URL = os.getenv('DB_URL') # overrides the MySQL settings above, e.g. sqlite:///timetable.sqlite
+DB_READ_URL = os.getenv('DB_READ_URL') # replica for the reads of the bot, the main database if empty
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5)) # connections kept open per engine
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10)) # extra connections under load, closed when returned
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30)) # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800)) # seconds, below the MySQL wait_timeout so idle connections are renewed before the server drops them
+DB_PRE_PING = os.getenv('DB_PRE_PING', '1') == '1' # test connections when taken from the pool
+DB_ASYNC = os.getenv('DB_ASYNC', '0') == '1' # asyncio drivers on the async path of the bot
+
+ASYNC_DRIVERS = {'mysql': 'aiomysql', 'sqlite': 'aiosqlite', 'postgresql': 'asyncpg'}
+
+engines = {} # (url, async) -> engine, one pool per database for the whole process
+lock = threading.Lock()
+
+
+def database_url(readonly=False) -> str:
+    if readonly and DB_READ_URL:
+        return DB_READ_URL
+    return DB_URL or f"mysql+pymysql://{db_config['user']}:{db_config['password']}@{db_config['host']}/{db_config['database']}"
+
+def pool_options(url) -> dict:
+    """Pool settings of the engine; SQLite is a local file, only the checks apply."""
+
+    options = {'pool_pre_ping': DB_PRE_PING, 'pool_recycle': DB_POOL_RECYCLE}
+    if make_url(url).get_backend_name() != 'sqlite':
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    return options
+
+def async_url(url):
+    """The URL with the asyncio driver of its database."""
+
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No asyncio driver for {backend}')
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+def get_engine(readonly=False, url=None):
+    """Shared engine of the database at the URL, the timetable database by default.
+    With readonly the replica of DB_READ_URL is used, if set."""
+
+    url = url or database_url(readonly)
+    with lock:
+        if (url, False) not in engines:
+            engines[(url, False)] = create_engine(url, **pool_options(url))
+        return engines[(url, False)]
+
+def get_async_engine(readonly=False, url=None):
+    """Shared asyncio engine of the database at the URL, or None unless DB_ASYNC is set."""
+
+    if not DB_ASYNC:
+        return None
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = url or database_url(readonly)
+    with lock:
+        if (url, True) not in engines:
+            engines[(url, True)] = create_async_engine(async_url(url), **pool_options(url))
+        return engines[(url, True)]
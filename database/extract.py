@@ -1,53 +1,60 @@
-import mysql.connector, os
-from mysql.connector import Error
+import os
 import pandas as pd
-from sqlalchemy import create_engine
+from datetime import datetime
+from sqlalchemy import text, Table, MetaData, Column, Integer, DateTime, select, update, insert
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.types import Date, Time
-
-db_config = {
-    'host': os.getenv('DB_HOST'), 
-    'user': os.getenv('DB_USER'),
-    'password': os.getenv('DB_PASSWORD'),
-    'database': os.getenv('DB_NAME')
-}
+from database.engine import get_engine
 
 DB_TABLE = os.getenv('DB_TABLE')
 
-def get_db_connection():
+metadata = MetaData()
+generation_table = Table(f'{DB_TABLE}_generation', metadata, # version of the timetable data
+    Column('id', Integer, primary_key=True, autoincrement=False),
+    Column('generation', Integer, nullable=False),
+    Column('updated_at', DateTime, nullable=False))
+
+def get_db_engine(readonly=False):
+    """Shared, pooled engine of the timetable database; readonly may go to the replica."""
+
     try:
-        connection = mysql.connector.connect(**db_config)
-        if connection.is_connected():
-            print("Database connection successful")
-        return connection
-    except Error as e:
+        return get_engine(readonly)
+    except SQLAlchemyError as e:
         print(f"Error: {e}")
         return None
     
 
-def get_db_engine():
+def get_generation(engine):
+    """Return the version of the timetable data, incremented on every reload."""
+
     try:
-        engine = create_engine(f"mysql+pymysql://{db_config['user']}:{db_config['password']}@{db_config['host']}/{db_config['database']}")
-        return engine
-    except Error as e:
+        with engine.connect() as connection:
+            generation = connection.execute(select(generation_table.c.generation).where(generation_table.c.id == 1)).scalar()
+    except SQLAlchemyError as e:
         print(f"Error: {e}")
-        return None
+        return 0
+    return generation or 0
+
+def bump_generation(connection):
+    """Increment the version of the timetable data within the transaction of the caller."""
+
+    now = datetime.now()
+    result = connection.execute(update(generation_table).where(generation_table.c.id == 1).values(
+        generation=generation_table.c.generation + 1, updated_at=now))
+    if not result.rowcount:
+        connection.execute(insert(generation_table).values(id=1, generation=1, updated_at=now))
     
 
 def fetch_data(query, params=None):
-    connection = get_db_connection()
-    if not connection:
-        return None
+    """Rows of the query as dictionaries; params use the paramstyle of the driver, e.g. %s for MySQL."""
+
     try:
-        cursor = connection.cursor(dictionary=True)  # Use dictionary=True for results as dictionaries
-        cursor.execute(query, params)
-        results = cursor.fetchall()
-        return results
-    except Error as e:
+        with get_db_engine(readonly=True).connect() as connection:
+            result = connection.exec_driver_sql(query, params) if params else connection.execute(text(query)) # text() escapes % for PyMySQL
+            return [dict(row) for row in result.mappings()]
+    except SQLAlchemyError as e:
         print(f"Error: {e}")
         return None
-    finally:
-        cursor.close()
-        connection.close()
 
 def insert_data(filename='timetable.csv', table_name=DB_TABLE):
     engine = get_db_engine()
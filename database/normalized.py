@@ -0,0 +1,168 @@
+import os
+from sqlalchemy import Table, MetaData, Column, Integer, String, Date, Time, ForeignKey, Index, select, insert, update, delete, func, inspect, text
+
+DB_TABLE = os.getenv('DB_TABLE')
+TIMETABLE_SCHEMA = os.getenv('TIMETABLE_SCHEMA', 'flat') # flat: one table; normalized: movies, cinemas and showtimes behind a view
+
+metadata = MetaData()
+cinemas_table = Table(f'{DB_TABLE}_cinemas', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(255), nullable=False, unique=True))
+movies_table = Table(f'{DB_TABLE}_movies', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('title', String(255), nullable=False),
+    Column('language', String(16), nullable=False, server_default=''),
+    Column('link', String(512), nullable=False, server_default=''),
+    Column('tmdb_id', Integer),
+    Index(f'ix_{DB_TABLE}_movies_title_language', 'title', 'language'))
+showtimes_table = Table(f'{DB_TABLE}_showtimes', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('movie_id', Integer, ForeignKey(movies_table.c.id), nullable=False),
+    Column('cinema_id', Integer, ForeignKey(cinemas_table.c.id), nullable=False),
+    Column('date', Date, nullable=False),
+    Column('time', Time, nullable=False),
+    Index(f'ix_{DB_TABLE}_showtimes_date_time', 'date', 'time'),
+    Index(f'ix_{DB_TABLE}_showtimes_movie_date', 'movie_id', 'date'), # with the title index of movies, for (title, date)
+    Index(f'ix_{DB_TABLE}_showtimes_cinema_date', 'cinema_id', 'date'))
+
+# Read view with the columns of the flat table, so the SQL prompt, the templates and the tools work unchanged;
+# missing languages and links are stored as '' to be part of the movie key and read back as NULL
+VIEW_SQL = f"""CREATE VIEW {{name}} AS
+SELECT s.id AS id, c.name AS cinema, m.title AS title, NULLIF(m.language, '') AS language, NULLIF(m.link, '') AS link, s.date AS date, s.time AS time
+FROM {DB_TABLE}_showtimes s
+JOIN {DB_TABLE}_movies m ON m.id = s.movie_id
+JOIN {DB_TABLE}_cinemas c ON c.id = s.cinema_id"""
+
+
+def create_schema(engine):
+    """Create the normalized tables, copy the rows of the flat table into them and put the read view in its place.
+    The flat table is kept as {DB_TABLE}_flat.
+
+    The view is first created as {DB_TABLE}_new, so a failing view leaves the flat table untouched, and then swapped
+    with the flat table in one step: a single RENAME TABLE on MySQL, where DDL commits implicitly, one transaction
+    elsewhere. The copy is repeated from scratch on the next run until the swap succeeds. To go back to the flat
+    table by hand: DROP VIEW {DB_TABLE}; then RENAME TABLE {DB_TABLE}_flat TO {DB_TABLE} (MySQL) or
+    ALTER TABLE {DB_TABLE}_flat RENAME TO {DB_TABLE}, and set TIMETABLE_SCHEMA=flat."""
+
+    metadata.create_all(engine)
+    inspector = inspect(engine)
+    if DB_TABLE in inspector.get_view_names():
+        return
+    if DB_TABLE not in inspector.get_table_names():
+        with engine.begin() as connection:
+            connection.execute(text(VIEW_SQL.format(name=DB_TABLE)))
+        return
+
+    with engine.begin() as connection:
+        migrate_flat(connection)
+    with engine.begin() as connection:
+        connection.execute(text(f'DROP VIEW IF EXISTS {DB_TABLE}_new')) # left by a failed swap
+        connection.execute(text(VIEW_SQL.format(name=f'{DB_TABLE}_new')))
+    with engine.begin() as connection:
+        if engine.dialect.name == 'mysql':
+            connection.execute(text(f'RENAME TABLE {DB_TABLE} TO {DB_TABLE}_flat, {DB_TABLE}_new TO {DB_TABLE}'))
+        else: # transactional DDL; SQLite can't rename views
+            connection.execute(text(f'ALTER TABLE {DB_TABLE} RENAME TO {DB_TABLE}_flat'))
+            connection.execute(text(f'DROP VIEW {DB_TABLE}_new'))
+            connection.execute(text(VIEW_SQL.format(name=DB_TABLE)))
+
+def migrate_flat(connection):
+    """Copy the showtimes of the flat table into the normalized tables, replacing what an earlier attempt copied."""
+
+    for table in (showtimes_table, movies_table, cinemas_table):
+        connection.execute(delete(table))
+    flat = Table(DB_TABLE, MetaData(), autoload_with=connection)
+    language, link = func.coalesce(flat.c.language, ''), func.coalesce(flat.c.link, '')
+    complete = [flat.c.cinema.isnot(None), flat.c.title.isnot(None), flat.c.date.isnot(None), flat.c.time.isnot(None)]
+
+    connection.execute(insert(cinemas_table).from_select(['name'], select(flat.c.cinema).where(*complete).distinct()))
+    connection.execute(insert(movies_table).from_select(['title', 'language', 'link'],
+                                                        select(flat.c.title, language, link).where(*complete).distinct()))
+    showtimes = (select(movies_table.c.id, cinemas_table.c.id, flat.c.date, flat.c.time)
+        .select_from(flat)
+        .join(movies_table, (movies_table.c.title == flat.c.title) & (movies_table.c.language == language) & (movies_table.c.link == link))
+        .join(cinemas_table, cinemas_table.c.name == flat.c.cinema)
+        .where(*complete))
+    connection.execute(insert(showtimes_table).from_select(['movie_id', 'cinema_id', 'date', 'time'], showtimes))
+
+
+class NormalizedTimetable():
+    """Writes of the crawler into the normalized tables; reads go through the view."""
+
+    def __init__(self, engine):
+        create_schema(engine)
+        self.table = Table(DB_TABLE, MetaData(), autoload_with=engine)
+
+    @staticmethod
+    def movie_key(record):
+        return (record['title'], record['language'] or '', record['link'] or '')
+
+    def cinema_ids(self, connection, names) -> dict:
+        """Ids of the cinemas, inserting the new ones."""
+
+        names = set(names)
+        ids = dict(connection.execute(select(cinemas_table.c.name, cinemas_table.c.id).where(cinemas_table.c.name.in_(names))).all())
+        missing = [{'name': name} for name in names if name not in ids]
+        if missing:
+            connection.execute(insert(cinemas_table), missing)
+            ids.update(connection.execute(select(cinemas_table.c.name, cinemas_table.c.id)
+                                          .where(cinemas_table.c.name.in_([row['name'] for row in missing]))).all())
+        return ids
+
+    def movie_ids(self, connection, keys) -> dict:
+        """Ids of the movies by (title, language, link), inserting the new ones."""
+
+        keys = set(keys)
+        titles = {title for title, _, _ in keys}
+        ids = {}
+        for i in range(0, len(titles), 500):
+            chunk = sorted(titles)[i:i+500]
+            rows = connection.execute(select(movies_table.c.title, movies_table.c.language, movies_table.c.link, movies_table.c.id)
+                                      .where(movies_table.c.title.in_(chunk)))
+            ids.update(((title, language, link), idx) for title, language, link, idx in rows if (title, language, link) in keys)
+        missing = [key for key in keys if key not in ids]
+        if missing:
+            connection.execute(insert(movies_table), [{'title': title, 'language': language, 'link': link} for title, language, link in missing])
+            return self.movie_ids(connection, keys)
+        return ids
+
+    def delete_all(self, connection) -> int:
+        return connection.execute(delete(showtimes_table)).rowcount
+
+    def delete_cinemas(self, connection, cinemas, before):
+        """Delete the showtimes of the cinemas and the ones of any cinema before the date."""
+
+        cinema_ids = select(cinemas_table.c.id).where(cinemas_table.c.name.in_(cinemas))
+        return connection.execute(delete(showtimes_table).where(showtimes_table.c.cinema_id.in_(cinema_ids) | (showtimes_table.c.date < before))).rowcount
+
+    def delete(self, connection, ids):
+        connection.execute(delete(showtimes_table).where(showtimes_table.c.id.in_(ids)))
+
+    def prune(self, connection):
+        """Delete the movies and cinemas left without showtimes."""
+
+        connection.execute(delete(movies_table).where(movies_table.c.id.not_in(select(showtimes_table.c.movie_id))))
+        connection.execute(delete(cinemas_table).where(cinemas_table.c.id.not_in(select(showtimes_table.c.cinema_id))))
+
+    def update_links(self, connection, updates):
+        """Point the showtimes to the movie with the new link, given (showtime id, crawled record) pairs."""
+
+        movie_ids = self.movie_ids(connection, [self.movie_key(record) for _, record in updates])
+        for row_id, record in updates:
+            connection.execute(update(showtimes_table).where(showtimes_table.c.id == row_id)
+                               .values(movie_id=movie_ids[self.movie_key(record)]))
+
+    def insert(self, connection, records):
+        cinema_ids = self.cinema_ids(connection, [record['cinema'] for record in records])
+        movie_ids = self.movie_ids(connection, [self.movie_key(record) for record in records])
+        connection.execute(insert(showtimes_table), [
+            {'movie_id': movie_ids[self.movie_key(record)], 'cinema_id': cinema_ids[record['cinema']],
+             'date': record['date'], 'time': record['time']}
+            for record in records])
+
+
+def set_tmdb_ids(connection, tmdb_ids: dict):
+    """Store the TMDB id found for each title."""
+
+    for title, tmdb_id in tmdb_ids.items():
+        connection.execute(update(movies_table).where(movies_table.c.title == title).values(tmdb_id=tmdb_id))
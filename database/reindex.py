@@ -0,0 +1,46 @@
+"""Copy the movie documents of another Chroma collection into the collection of the configured embedding backend.
+The documents are embedded again with the new model, TMDB is not queried.
+
+    EMBEDDING_BACKEND=local python -m database.reindex                  # from the Mistral collection
+    EMBEDDING_BACKEND=local python -m database.reindex --drop           # and delete the Mistral collection
+    python -m database.reindex --source movies_sentence_transformers_...  # back to Mistral
+"""
+
+import argparse
+from langchain_core.documents import Document
+from database.vectorstore import vectordb, bump_version, DEFAULT_COLLECTION, EMBED_BATCH_SIZE
+
+
+def reindex(source=DEFAULT_COLLECTION, drop=False, batch_size=EMBED_BATCH_SIZE):
+    """Embed the documents of the source collection into the current one and return how many were copied."""
+
+    target = vectordb._collection.name
+    if source == target:
+        raise ValueError(f'{source} is already the collection of the configured embedding backend')
+    stored = vectordb._client.get_collection(source).get(include=['documents', 'metadatas'])
+    docs = [Document(page_content=content, metadata=metadata or {}, id=idx)
+            for idx, content, metadata in zip(stored['ids'], stored['documents'], stored['metadatas'])]
+
+    for i in range(0, len(docs), batch_size):
+        batch = docs[i:i+batch_size]
+        vectordb.add_documents(batch, ids=[doc.id for doc in batch])
+        print(f'{target}: {min(i + batch_size, len(docs))}/{len(docs)} documents')
+    bump_version()
+
+    if drop:
+        vectordb._client.delete_collection(source)
+    return len(docs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', default=DEFAULT_COLLECTION)
+    parser.add_argument('--drop', action='store_true')
+    args = parser.parse_args()
+
+    reindex(args.source, args.drop)
+    print(vectordb._collection.count())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""Cinema scraper plugins.
+
+Every module of this package describes one website: a Scraper subclass decorated with @register
+that fetches the page, parses it into raw records and normalizes them. Adding a cinema means
+adding a module here, the crawler picks it up through load_plugins()."""
+
+import re, requests, os, queue, threading, atexit, importlib, pkgutil
+from contextlib import contextmanager
+from datetime import date, time
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, FeatureNotFound
+
+CRAWL_WORKERS = int(os.getenv('CRAWL_WORKERS', 8)) # cinemas crawled at the same time
+CRAWL_BROWSERS = int(os.getenv('CRAWL_BROWSERS', 1)) # headless browsers for JS-heavy websites
+CRAWL_BROWSER = os.getenv('CRAWL_BROWSER', 'auto') # auto: only when the plain HTML lacks the data, never or always
+SCRAPER_TIMEOUT = float(os.getenv('SCRAPER_TIMEOUT', 60)) # seconds for a whole attempt of one scraper
+SCRAPER_RETRIES = int(os.getenv('SCRAPER_RETRIES', 1))
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', 20))
+HTML_PARSER = os.getenv('HTML_PARSER', 'lxml') # tree builder of BeautifulSoup, html.parser if lxml is not installed
+
+HEADERS = {'User-Agent': 'Mozilla/5.0 (iPad; CPU OS 12_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148'}
+
+SESSION = requests.Session() # keeps connections to the cinema websites alive
+SESSION.headers.update(HEADERS)
+SESSION.mount('https://', HTTPAdapter(pool_connections=CRAWL_WORKERS, pool_maxsize=CRAWL_WORKERS))
+
+SCRAPERS = {}
+
+
+class DriverPool():
+    """A small pool of headless Chrome drivers shared by the scrapers that need JavaScript.
+    Drivers are started only when a scraper asks for one and are shut down by close().
+    A driver that failed, or was aborted because its scraper hung, is quit instead of being returned to the pool."""
+
+    def __init__(self, size=CRAWL_BROWSERS):
+        self.size = size
+        self.created = 0
+        self.drivers = queue.Queue()
+        self.in_use = {} # thread id -> driver lent to the thread
+        self.lock = threading.Lock()
+
+    def new_driver(self):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+
+        chrome_options = Options()
+        chrome_options.add_argument("--headless")
+        driver = webdriver.Chrome(options=chrome_options)
+        driver.set_page_load_timeout(REQUEST_TIMEOUT)
+        driver.set_script_timeout(REQUEST_TIMEOUT)
+        return driver
+
+    @contextmanager
+    def driver(self, timeout=SCRAPER_TIMEOUT):
+        with self.lock:
+            start = self.drivers.empty() and self.created < self.size
+            if start:
+                self.created += 1
+        if start:
+            try:
+                driver = self.new_driver()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        else:
+            try:
+                driver = self.drivers.get(timeout=timeout)
+            except queue.Empty:
+                raise RuntimeError(f"No browser free after {timeout} seconds") from None
+        thread = threading.get_ident()
+        with self.lock:
+            self.in_use[thread] = driver
+        healthy = False
+        try:
+            yield driver
+            healthy = True
+        finally:
+            with self.lock:
+                lent = self.in_use.pop(thread, None) is driver # not if abort() took it back
+            if healthy and lent:
+                self.drivers.put(driver)
+            elif lent:
+                self.discard(driver)
+
+    def abort(self, thread):
+        """Quit the driver lent to the thread, so that its pending calls fail instead of hanging."""
+
+        with self.lock:
+            driver = self.in_use.pop(thread, None)
+        if driver is not None:
+            self.discard(driver)
+
+    def discard(self, driver):
+        with self.lock:
+            self.created -= 1
+        try:
+            driver.quit()
+        except Exception as e:
+            print(f"Error while closing the browser: {e}")
+
+    def close(self):
+        """Quit all idle drivers."""
+
+        while True:
+            try:
+                driver = self.drivers.get_nowait()
+            except queue.Empty:
+                break
+            self.discard(driver)
+
+DRIVER_POOL = DriverPool()
+atexit.register(DRIVER_POOL.close)
+
+
+def clean_title(title):
+    """Clean the movie title."""
+
+    title = title.lower()
+    if title.endswith('autism friendly'):
+        title = title[:-16]
+    elif title.endswith('al cinema con te'):
+        title = title[:-19]
+    elif title.endswith('evento contro il bullismo'):
+        title = title[:-26]
+    title = re.sub(r'[\:\-–]', '', title)
+    title = re.sub(r'\s{2,}', ' ', title)
+    title = re.sub(r'\s+\([12][09][0-9][0-9]\)', '', title)
+    return title.strip()
+
+def make_soup(markup, parser=None):
+    """Parse the page with the configured parser, falling back to the one of the standard library."""
+
+    try:
+        return BeautifulSoup(markup, parser or HTML_PARSER)
+    except FeatureNotFound:
+        return BeautifulSoup(markup, 'html.parser')
+
+def fetch(url):
+    """Download the page without a browser."""
+
+    response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 200:
+        soup = make_soup(response.content)
+        return soup
+    else:
+        print(f"Failed to retrieve the webpage. Status code: {response.status_code}")
+        return None
+
+def render(url, selector):
+    """Load the page in a headless browser and wait for the elements with the data."""
+
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
+    with DRIVER_POOL.driver() as driver:
+        driver.get(url)
+        try:
+            element = WebDriverWait(driver, 5).until(EC.presence_of_element_located((By.CSS_SELECTOR, selector)))
+        except:
+            print("Loading timed out.")
+            return None
+        finally:
+            page_source = driver.page_source
+            soup = make_soup(page_source)
+            return soup
+
+
+class Scraper():
+    """Base class of the cinema scrapers: fetch -> parse -> normalize."""
+
+    name = None # key of the scraper in SCRAPERS
+    cinema = None # name of the cinema in the records
+    url = None
+    browser_element = None # id of the element filled by JavaScript, for websites that need a browser
+    browser_ready = None # CSS selector present only once the data is loaded, any child of browser_element by default
+    timeout = SCRAPER_TIMEOUT
+    retries = SCRAPER_RETRIES
+
+    def fetch(self):
+        """Download the page, with a browser only if the plain HTML lacks the data."""
+
+        if not self.browser_element:
+            return fetch(self.url)
+        ready = self.browser_ready or f'#{self.browser_element} > *'
+        if CRAWL_BROWSER != 'always':
+            soup = fetch(self.url)
+            if soup and soup.select_one(ready): # the data is already in the HTML
+                return soup
+        if CRAWL_BROWSER == 'never':
+            print(f"{self.name} needs a browser, skipping.")
+            return None
+        return render(self.url, ready)
+
+    def parse(self, soup) -> list[dict]:
+        """Extract records with cinema, title, language, link, date and time from the page."""
+
+        raise NotImplementedError
+
+    def normalize(self, records: list[dict]) -> list[dict]:
+        """Clean the titles, drop incomplete records and turn the ISO dates and times into date and time objects."""
+
+        for record in records:
+            record['title'] = clean_title(record['title'])
+        records = [record for record in records if record['title'] and record['date'] and record['time']]
+        for record in records:
+            if not isinstance(record['date'], date):
+                record['date'] = date.fromisoformat(record['date'][:10])
+            if not isinstance(record['time'], time):
+                record['time'] = time.fromisoformat(record['time'].zfill(8))
+        return records
+
+    @classmethod
+    def covers(cls, cinema) -> bool:
+        """Whether the stored showtimes of the cinema come from this scraper."""
+
+        return cinema == cls.cinema
+
+    def run(self) -> list[dict]:
+        soup = self.fetch()
+        if soup is None:
+            raise RuntimeError(f"{self.url} is not available")
+        return self.normalize(self.parse(soup))
+
+
+def register(scraper):
+    """Class decorator adding a scraper to the registry."""
+
+    SCRAPERS[scraper.name] = scraper
+    return scraper
+
+def load_plugins():
+    """Import every module of the package, so that their scrapers get registered."""
+
+    for module in pkgutil.iter_modules(__path__):
+        importlib.import_module(f'{__name__}.{module.name}')
+    return SCRAPERS
@@ -0,0 +1,54 @@
+from datetime import datetime
+from database.scrapers import Scraper, register
+
+MONTHS = {'Gennaio': '01', 'Febbraio': '02', 'Marzo': '03', 'Aprile': '04', 'Maggio': '05', 'Giugno': '06', 'Luglio': '07', 'Agosto': '08', 'Settembre': '09', 'Ottobre': '10', 'Novembre': '11', 'Dicembre': '12'}
+
+
+@register
+class CircuitoScraper(Scraper):
+    """Circuito Cinema Genova, a single page listing several cinemas."""
+
+    name = 'Circuito'
+    cinema = 'Circuito ' # followed by the name of each cinema
+    url = 'https://circuitocinemagenova.com/programmazione-settimanale/'
+
+    @classmethod
+    def covers(cls, cinema):
+        return cinema.startswith(cls.cinema)
+
+    def parse(self, soup):
+        timetable = []
+        today_year = datetime.now().year
+        for cinema in soup.select('div.cinema_row'):
+            name = cinema.select('h2')[0].get_text()
+            for film in cinema.select('div.single-film'):
+                title = film.select('p')[0].get_text().lower().strip()
+                if title.endswith('- v. o.'):
+                    title = title[:-8]
+                    language = 'en'
+                elif title.endswith('- vers.orig.sott.it'):
+                    title = title[:-20]
+                    language = 'en'
+                elif title.endswith('vers. orig. sott.'):
+                    title = title[:-18]
+                    language = 'en'
+                else:
+                    language = 'it'
+                days = film.select('div.day_block')
+                if not days:
+                    continue
+                href = film.select('a.theme-btn')[0].get('href')
+                for day in days:
+                    date = day.select('h4')[0].get_text().split(' ')
+                    date = f'{today_year}-{MONTHS[date[-1]]}-{date[1].zfill(2)}'
+                    hours = day.select('span.start_hour')
+                    hours = [hour.get_text().strip() + ':00' for hour in hours]
+                    for time in hours:
+                        timetable.append({
+                            'cinema': self.cinema + name,
+                            'title': title,
+                            'language': language,
+                            'link': href,
+                            'date': date,
+                            'time': time})
+        return timetable
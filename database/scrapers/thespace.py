@@ -0,0 +1,37 @@
+from database.scrapers import Scraper, register
+
+
+@register
+class TheSpaceScraper(Scraper):
+    """The Space Cinema Genova, whose timetable is filled by JavaScript."""
+
+    name = 'TheSpace'
+    cinema = 'TheSpace'
+    url = 'https://www.thespacecinema.it/al-cinema/genova'
+    browser_element = 'filmlist__data'
+    browser_ready = '#filmlist__data > div.filmlist__item' # the container holds a placeholder until the list is loaded
+
+    def parse(self, soup):
+        movies = soup.select('#filmlist__data > div.filmlist__item')
+        movies = [movie for movie in movies if movie.get('data-hidden') == 'false']
+        timetable = []
+        for movie in movies:
+            title = movie.select('div.filmlist__info > div > a > span')[0].get_text().lower()
+            if title.endswith('versione originale'):
+                title = title[:-21]
+                language = 'en'
+            else:
+                language = 'it'
+
+            href = 'https://www.thespacecinema.it' + movie.select('div.filmlist__info > div > a')[0].get('href')
+
+            for day in movie.select('div.day'):
+                for timeslot in day.select('time.default'):
+                    timetable.append({
+                        'cinema': self.cinema,
+                        'title': title,
+                        'language': language,
+                        'link': href,
+                        'date': timeslot.get('datetime'),
+                        'time': timeslot.get_text() + ":00"})
+        return timetable
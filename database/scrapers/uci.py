@@ -0,0 +1,56 @@
+from database.scrapers import Scraper, register
+
+
+@register
+class UCIScraper(Scraper):
+    """UCI Cinemas Fiumara."""
+
+    name = 'UCI'
+    cinema = 'UCI Fiumara'
+    url = 'https://www.ucicinemas.it/cinema/liguria/genova/uci-cinemas-fiumara-genova/'
+
+    def parse(self, soup):
+        dates = soup.select('#showtimes-venue-container > header > div > ul > li > a')
+        dates = [date['data-day'] for date in dates]
+        days = {element['id'][6:]: element for element in soup.select('[id^="movie_"]')} # one pass instead of a select per date
+
+        data = {} # (title, language) -> link and showtimes per date
+        for date in dates:
+            day = days.get(date)
+            if day is None:
+                continue
+            movies = day.find_all('div', class_='showtimes__show', recursive=False)
+
+            date = [date[i:i+2] for i in range(0, len(date), 2)]
+            date = f"20{date[2]}-{date[1]}-{date[0]}"
+
+            for movie in movies:
+                titles = movie.select('span.movie-name > a')
+                showtimes = movie.select('ul.showtimes__movie__shows > li > a')
+                showtimes = [showtime.get_text() + ":00" for showtime in showtimes]
+                for title in titles:
+                    name = title.get_text().lower()
+                    if name.startswith('(o.v.)'):
+                        name = name[7:]
+                        language = 'en'
+                    elif name.startswith('(jp)'):
+                        name = name[5:]
+                        language = 'jp'
+                    elif name.startswith('(kor)'):
+                        name = name[6:]
+                        language = 'kor'
+                    else:
+                        language = 'it'
+
+                    record = data.setdefault((name, language), {'link': 'https://www.ucicinemas.it' + title['href'], 'dates': {}})
+                    record['dates'].setdefault(date, []).extend(showtimes)
+
+        return [{"cinema": self.cinema,
+                 "title": name,
+                 "language": language,
+                 "link": record['link'],
+                 "date": date,
+                 "time": time}
+                for (name, language), record in data.items()
+                for date, times in record['dates'].items()
+                for time in times]
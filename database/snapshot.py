@@ -0,0 +1,110 @@
+import os, time, threading
+from datetime import date, time as dt_time
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from database.extract import get_generation
+
+DB_TABLE = os.getenv('DB_TABLE')
+TIMETABLE_SNAPSHOT = os.getenv('TIMETABLE_SNAPSHOT', '1') == '1' # answer the showtime templates from process memory
+SNAPSHOT_TTL = float(os.getenv('SNAPSHOT_TTL', 60)) # seconds between checks of the timetable version
+
+COLUMNS = ('cinema', 'title', 'language', 'date', 'time', 'link')
+
+
+def seconds(value) -> int:
+    """Seconds since midnight of a time, a timedelta (MySQL TIME) or an H:MM[:SS] string."""
+
+    if isinstance(value, dt_time):
+        return value.hour * 3600 + value.minute * 60 + value.second
+    if hasattr(value, 'total_seconds'):
+        return int(value.total_seconds())
+    parts = [int(part) for part in str(value).split('.')[0].split(':')] + [0, 0]
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+class Column():
+    """Strings as integer codes into the sorted distinct values, so filters compare integers."""
+
+    def __init__(self, values):
+        self.values = sorted({value for value in values if value is not None})
+        self.index = {value: i for i, value in enumerate(self.values)}
+        self.codes = np.array([self.index.get(value, -1) for value in values], dtype=np.int32) # -1 for NULL
+
+    def code(self, value) -> int:
+        return self.index.get(value, -2) # -2 matches nothing
+
+    def decode(self, code):
+        return self.values[code] if code >= 0 else None
+
+
+class TimetableSnapshot():
+    """Columnar copy of the timetable in process memory, sorted by date and time.
+    It is reloaded when the crawler publishes a new generation, and kept as it is while the database is unreachable."""
+
+    def __init__(self, engine, ttl=SNAPSHOT_TTL):
+        self.engine = engine
+        self.ttl = ttl
+        self.generation = None
+        self.checked_at = 0.0
+        self.data = None # (string columns, dates, times in seconds), replaced at once on reload
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.generation is not None
+
+    def refresh(self, force=False) -> bool:
+        """Reload the snapshot if the timetable changed since the last load; return whether one is loaded."""
+
+        with self.lock:
+            if not force and self.loaded and time.monotonic() - self.checked_at < self.ttl:
+                return True
+            generation = get_generation(self.engine) # 0 if the database is unreachable
+            self.checked_at = time.monotonic()
+            if force or (generation != self.generation and not (generation == 0 and self.generation)):
+                try:
+                    self.load(generation)
+                except SQLAlchemyError as e:
+                    print(f"Error: {e}")
+            return self.loaded
+
+    def load(self, generation):
+        with self.engine.connect() as connection:
+            rows = connection.execute(text(f"""SELECT {", ".join(COLUMNS)} FROM {DB_TABLE}
+WHERE date IS NOT NULL AND time IS NOT NULL ORDER BY date, time""")).fetchall()
+        cinemas, titles, languages, dates, times, links = zip(*rows) if rows else ([],) * 6
+        columns = {'cinema': Column(cinemas), 'title': Column(titles), 'language': Column(languages), 'link': Column(links)}
+        self.data = (columns, np.array([str(day)[:10] for day in dates], dtype='datetime64[D]'),
+                     np.array([seconds(value) for value in times], dtype=np.int32))
+        self.generation = generation
+        print(f'Timetable snapshot of {len(rows)} showtimes loaded, generation {generation}')
+
+    def query(self, title=None, cinemas=None, language=None, date_from=None, date_to=None, time_from=None, time_to=None,
+              limit=None) -> list[tuple]:
+        """Showtimes as (cinema, title, language, date, time, link) rows ordered by date and time, like the SQL template.
+        Dates are ISO strings, times H:MM; without dates the showtimes from today on are returned."""
+
+        columns, dates, times = self.data
+        mask = np.ones(len(dates), dtype=bool)
+        if title:
+            mask &= columns['title'].codes == columns['title'].code(title)
+        if cinemas:
+            mask &= np.isin(columns['cinema'].codes, [columns['cinema'].code(cinema) for cinema in cinemas])
+        if language:
+            mask &= columns['language'].codes == columns['language'].code(language)
+        if date_from:
+            mask &= (dates >= np.datetime64(date_from, 'D')) & (dates <= np.datetime64(date_to or date_from, 'D'))
+        else:
+            mask &= dates >= np.datetime64(date.today(), 'D')
+        if time_from:
+            mask &= times >= seconds(time_from)
+        if time_to:
+            mask &= times <= seconds(time_to)
+
+        rows = []
+        for i in np.flatnonzero(mask)[:limit]:
+            rows.append((columns['cinema'].decode(columns['cinema'].codes[i]), columns['title'].decode(columns['title'].codes[i]),
+                         columns['language'].decode(columns['language'].codes[i]), dates[i].item(),
+                         dt_time(*divmod(int(times[i]) // 60, 60), int(times[i]) % 60), columns['link'].decode(columns['link'].codes[i])))
+        return rows
@@ -1,53 +1,134 @@
-from tmdbv3api import TMDb, Movie
 from langchain_core.documents import Document
-from langchain_chroma import Chroma
-from langchain_mistralai import MistralAIEmbeddings
-from extract import fetch_data
-import hashlib, os
+from concurrent.futures import ThreadPoolExecutor
+from database.extract import fetch_data, get_db_engine
+from database.normalized import TIMETABLE_SCHEMA, set_tmdb_ids
+from database.vectorstore import vectordb, bump_version, EMBED_BATCH_SIZE
+import hashlib, os, sys, json, sqlite3, threading, time, requests
 
 
 TMDB_API_KEY = os.getenv("TMDB_API_KEY")
-MISTRALAI_API_KEY = os.getenv("MISTRALAI_API_KEY")
 DB_TABLE = os.getenv("DB_TABLE")
+TMDB_WORKERS = int(os.getenv("TMDB_WORKERS", 8))
+TMDB_RATE_LIMIT = float(os.getenv("TMDB_RATE_LIMIT", 20)) # requests per second
+TMDB_CACHE_PATH = os.getenv("TMDB_CACHE_PATH", 'database/tmdb_cache.sqlite')
 
-tmdb = TMDb()
-tmdb.api_key = TMDB_API_KEY
-movie = Movie()
+TMDB_URL = 'https://api.themoviedb.org/3'
+session = requests.Session()
 
-embeddings = MistralAIEmbeddings(api_key=MISTRALAI_API_KEY)
 
-persist_directory = 'chroma/' # Chroma vector store
-vectordb = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
+class RateLimiter():
+    """Spread requests evenly, at most `rate` per second across all threads."""
+
+    def __init__(self, rate=TMDB_RATE_LIMIT):
+        self.interval = 1 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0, slot - now))
+
+rate_limiter = RateLimiter()
+
+
+class TMDBCache():
+    """On-disk cache of TMDB searches (title -> TMDB id) and movie details (TMDB id -> response)."""
+
+    def __init__(self, path=TMDB_CACHE_PATH):
+        self.path = path
+        with self.connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS searches (title TEXT PRIMARY KEY, tmdb_id INTEGER)')
+            connection.execute('CREATE TABLE IF NOT EXISTS details (tmdb_id INTEGER PRIMARY KEY, response TEXT)')
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get_search(self, title):
+        """Return (found, tmdb_id); tmdb_id is None for titles TMDB doesn't know."""
+
+        with self.connect() as connection:
+            row = connection.execute('SELECT tmdb_id FROM searches WHERE title = ?', (title,)).fetchone()
+        return (True, row[0]) if row else (False, None)
+
+    def set_search(self, title, tmdb_id):
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO searches VALUES (?, ?)', (title, tmdb_id))
+
+    def get_details(self, tmdb_id):
+        with self.connect() as connection:
+            row = connection.execute('SELECT response FROM details WHERE tmdb_id = ?', (tmdb_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_details(self, tmdb_id, details):
+        with self.connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO details VALUES (?, ?)', (tmdb_id, json.dumps(details)))
+
+tmdb_cache = TMDBCache()
+
+
+def tmdb_get(path, **params):
+    """Call the TMDB API within the rate limit, waiting out 429 responses."""
+
+    for attempt in range(3):
+        rate_limiter.wait()
+        response = session.get(f'{TMDB_URL}{path}', params={'api_key': TMDB_API_KEY, 'language': 'en-US', **params}, timeout=20)
+        if response.status_code == 429:
+            time.sleep(float(response.headers.get('Retry-After', 1)))
+            continue
+        response.raise_for_status()
+        return response.json()
+    response.raise_for_status()
+
+def search_movie(title):
+    """Return the TMDB id of the best match for the title, or None."""
+
+    found, tmdb_id = tmdb_cache.get_search(title)
+    if not found:
+        results = tmdb_get('/search/movie', query=title).get('results')
+        tmdb_id = results[0]['id'] if results else None
+        tmdb_cache.set_search(title, tmdb_id)
+    return tmdb_id
+
+def movie_details(tmdb_id):
+    details = tmdb_cache.get_details(tmdb_id)
+    if details is None:
+        details = tmdb_get(f'/movie/{tmdb_id}', append_to_response='casts')
+        tmdb_cache.set_details(tmdb_id, details)
+    return details
+
 
 def hash_title(s):
     """Hash a string and return the first 8 digits."""
 
     hash_s = int(hashlib.sha1(s.encode("utf-8")).hexdigest(), 16) % (10 ** 8)
-    return str(hash_s) 
+    return str(hash_s)
 
 
 def find_movie(title):
     """Search for a movie in TMDB database and return a Document object with movie details."""
-    
-    try:
-        result = movie.search(title)[0]
-    except TypeError:
+
+    tmdb_id = search_movie(title)
+    metadata = {'source': 'TMDB', 'sql_db_title': title}
+    if tmdb_id is None:
         print(f'Movie {title} not found')
         description = 'Movie not found'
         info = ''
     else:
-        result = movie.details(result.id)
+        result = movie_details(tmdb_id)
         genres = [genre['name'] for genre in result['genres']]
-        
+
         try:
             country = result['production_countries'][0]['name']
-        except TypeError:
+        except (IndexError, KeyError):
             country = ''
-        
-        cast = [person.name for person in result['casts']['cast']]
-        duration = result['runtime'] if result['runtime'] > 0 else ''
-        director = [person.name for person in result['casts']['crew'] if person.job == 'Director']
-        orig_title = f'(original title: {result['original_title']})' if result['original_title'] != result['title'] else ''
+
+        cast = [person['name'] for person in result['casts']['cast']]
+        duration = result['runtime'] if (result['runtime'] or 0) > 0 else ''
+        director = [person['name'] for person in result['casts']['crew'] if person['job'] == 'Director']
+        orig_title = f"(original title: {result['original_title']})" if result['original_title'] != result['title'] else ''
         description = f"""{result['title']} {orig_title}\n\n{result['overview']}"""
         info = f"""Title: {result['title']} {orig_title}
     Movie is released in {country} on {result['release_date']} with duration of {duration} minutes.
@@ -55,29 +136,52 @@ def find_movie(title):
     Cast: {", ".join(cast[:7])}
     Rating: {result['vote_average']} (TMDb)
     Genres: {", ".join(genres)}"""
+        # Chroma metadata only holds scalars, lists are stored comma separated
+        metadata.update({'tmdb_id': tmdb_id, 'title': result['title'], 'original_title': result['original_title'],
+                         'director': ", ".join(director), 'cast': ", ".join(cast[:7]), 'genres': ", ".join(genres),
+                         'runtime': result['runtime'] or 0, 'year': int((result['release_date'] or '0')[:4]),
+                         'rating': float(result['vote_average'] or 0)})
 
-    docs = [Document(page_content=description, metadata={'source': 'TMDB', 'type': 'description', 'sql_db_title': title}, id=hash_title(title+'d')),
-            Document(page_content=info, metadata={'source': 'TMDB', 'type': 'info', 'sql_db_title': title}, id=hash_title(title+'i'))]
+    docs = [Document(page_content=description, metadata={**metadata, 'type': 'description'}, id=hash_title(title+'d')),
+            Document(page_content=info, metadata={**metadata, 'type': 'info'}, id=hash_title(title+'i'))]
     return docs
 
-def fill_chroma_db(titles: dict[str] = None):
-    """Fill the Chroma database with movie details from TMDB database."""
+def safe_find_movie(title):
+    try:
+        return find_movie(title)
+    except requests.RequestException as e:
+        print(f'Error while searching {title}: {e}')
+        return []
+
+def fill_chroma_db(titles: dict[str] = None, refresh=False):
+    """Fill the Chroma database with movie details from TMDB database.
+    With refresh the documents of stored titles are rebuilt too, e.g. to add new metadata fields."""
 
     if not titles:
-        query = f"SELECT DISTINCT title FROM {DB_TABLE}"
+        table = f'{DB_TABLE}_movies' if TIMETABLE_SCHEMA == 'normalized' else DB_TABLE
+        query = f"SELECT DISTINCT title FROM {table}"
         titles = fetch_data(query)
-    docs = []
-    for row in titles:
-        title, idx = row['title'], hash_title(row['title']+'d')
-        search = vectordb.get(limit=1, ids=idx)["ids"]
-        if not search:
-            doc = find_movie(title)
-            docs += doc
+    titles = list(dict.fromkeys(row['title'] for row in titles))
+    if not titles:
+        return True
+
+    ids = [hash_title(title+'d') for title in titles]
+    stored = set(vectordb.get(ids=ids, include=[])["ids"]) # one lookup for all titles
+    missing = titles if refresh else [title for title, idx in zip(titles, ids) if idx not in stored]
+
+    with ThreadPoolExecutor(max_workers=TMDB_WORKERS) as executor:
+        docs = [doc for movie_docs in executor.map(safe_find_movie, missing) for doc in movie_docs]
+    for i in range(0, len(docs), EMBED_BATCH_SIZE):
+        batch = docs[i:i+EMBED_BATCH_SIZE]
+        vectordb.add_documents(batch, ids=[doc.id for doc in batch])
     if docs:
-        vectordb.from_documents(docs, embedding=embeddings, persist_directory=persist_directory)
+        bump_version()
+    if TIMETABLE_SCHEMA == 'normalized':
+        with get_db_engine().begin() as connection:
+            set_tmdb_ids(connection, {doc.metadata['sql_db_title']: doc.metadata['tmdb_id'] for doc in docs if 'tmdb_id' in doc.metadata})
     return True
 
 
 if __name__ == '__main__':
-    fill_chroma_db()
+    fill_chroma_db(refresh='--refresh' in sys.argv)
     print(vectordb._collection.count())
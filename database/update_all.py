@@ -1,8 +1,8 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from crawl import Database
-from tmdb_movies import fill_chroma_db
+from database.crawl import Database
+from database.tmdb_movies import fill_chroma_db
 
 db = Database()
 result = db.crawl_timetable()
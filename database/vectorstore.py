@@ -0,0 +1,173 @@
+from langchain_core.embeddings import Embeddings
+from langchain_chroma import Chroma
+from langchain_mistralai import MistralAIEmbeddings
+import hashlib, importlib, os, re, sqlite3, threading
+from collections import Counter
+import numpy as np
+from LLM.client import llm_client
+
+MISTRALAI_API_KEY = os.getenv("MISTRALAI_API_KEY")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", 'database/embedding_cache.sqlite')
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 64))
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", 'mistral') # mistral, local or module:Class
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+LOCAL_EMBEDDING_THREADS = int(os.getenv("LOCAL_EMBEDDING_THREADS", 0)) # 0 lets onnxruntime decide
+CHROMA_DIR = os.getenv("CHROMA_DIR", 'database/chroma/')
+DEFAULT_COLLECTION = 'langchain' # collection of the Mistral embeddings, created before backends were configurable
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings in front of a model, cached in SQLite by a hash of the model name and the text.
+    Only the texts not seen before are sent to the model, in batches."""
+
+    def __init__(self, embeddings: Embeddings, model: str, path=EMBEDDING_CACHE_PATH, batch_size=EMBED_BATCH_SIZE, client=None):
+        self.embeddings = embeddings
+        self.client = client # rate limits and retries the calls of remote models
+        self.stats = Counter()
+        self.model = model
+        self.path = path
+        self.batch_size = batch_size
+        with self.connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, vector BLOB)')
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def key(self, kind, text):
+        return hashlib.sha256(f'{self.model}\n{kind}\n{text}'.encode('utf-8')).hexdigest()
+
+    def load(self, keys):
+        vectors = {}
+        with self.connect() as connection:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                rows = connection.execute(f"SELECT key, vector FROM vectors WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                vectors.update((key, np.frombuffer(vector, dtype=np.float32).tolist()) for key, vector in rows)
+        return vectors
+
+    def save(self, items):
+        with self.connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO vectors VALUES (?, ?)',
+                [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items])
+
+    def compute(self, func, *args):
+        return self.client.call(func, *args) if self.client else func(*args)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self.key('document', text) for text in texts]
+        vectors = self.load(list(set(keys)))
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in vectors))
+        self.stats.update(hits=len(texts) - len(missing), misses=len(missing))
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i:i+self.batch_size]
+            computed = [(self.key('document', text), vector) for text, vector in zip(batch, self.compute(self.embeddings.embed_documents, batch))]
+            self.save(computed)
+            vectors.update(computed)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self.key('query', text)
+        vector = self.load([key]).get(key)
+        self.stats['hits' if vector is not None else 'misses'] += 1
+        if vector is None:
+            vector = self.compute(self.embeddings.embed_query, text)
+            self.save([(key, vector)])
+        return vector
+
+
+class LocalEmbeddings(Embeddings):
+    """Sentence embeddings computed on the CPU with onnxruntime, from the ONNX export of a Hugging Face model.
+    The model is downloaded on first use; texts are embedded in batches, mean pooled and normalized."""
+
+    def __init__(self, model=LOCAL_EMBEDDING_MODEL, batch_size=EMBED_BATCH_SIZE, threads=LOCAL_EMBEDDING_THREADS, max_length=256):
+        self.model = model
+        self.batch_size = batch_size
+        self.threads = threads
+        self.max_length = max_length
+        self.session = None
+        self.tokenizer = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.session is None:
+                import onnxruntime
+                from huggingface_hub import hf_hub_download
+                from tokenizers import Tokenizer
+
+                tokenizer = Tokenizer.from_file(hf_hub_download(self.model, 'tokenizer.json'))
+                tokenizer.enable_truncation(max_length=self.max_length)
+                tokenizer.enable_padding()
+                options = onnxruntime.SessionOptions()
+                if self.threads:
+                    options.intra_op_num_threads = self.threads
+                self.session = onnxruntime.InferenceSession(hf_hub_download(self.model, 'onnx/model.onnx'), options,
+                                                            providers=['CPUExecutionProvider'])
+                self.tokenizer = tokenizer
+        return self.session, self.tokenizer
+
+    def embed_batch(self, texts: list[str]) -> np.ndarray:
+        session, tokenizer = self.load()
+        encodings = tokenizer.encode_batch(texts)
+        ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {'input_ids': ids, 'attention_mask': mask, 'token_type_ids': np.zeros_like(ids)}
+        inputs = {input.name: inputs[input.name] for input in session.get_inputs()}
+        tokens = session.run(None, inputs)[0]
+        vectors = (tokens * mask[..., None]).sum(axis=1) / np.maximum(mask.sum(axis=1, keepdims=True), 1)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = [self.embed_batch(texts[i:i+self.batch_size]) for i in range(0, len(texts), self.batch_size)]
+        return np.concatenate(vectors).tolist() if vectors else []
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_batch([text])[0].tolist()
+
+
+def load_backend(backend=EMBEDDING_BACKEND) -> tuple[Embeddings, str]:
+    """Embedding model of the backend and its name, which keys the cache and the Chroma collection."""
+
+    if backend == 'mistral':
+        return MistralAIEmbeddings(api_key=MISTRALAI_API_KEY), 'mistral-embed'
+    if backend == 'local':
+        return LocalEmbeddings(), LOCAL_EMBEDDING_MODEL
+    module, _, name = backend.partition(':')
+    if not name:
+        raise ValueError(f'Unknown embedding backend {backend!r}, expected mistral, local or module:Class')
+    return getattr(importlib.import_module(module), name)(), backend
+
+def collection_name(backend, model) -> str:
+    """Each embedding model gets its own collection, vectors of different models can't be compared."""
+
+    if backend == 'mistral':
+        return DEFAULT_COLLECTION
+    return re.sub(r'[^a-zA-Z0-9]+', '_', f'movies_{model}').strip('_')[:63]
+
+
+embedding_model, model_name = load_backend()
+embeddings = CachedEmbeddings(embedding_model, model=model_name, client=llm_client if EMBEDDING_BACKEND == 'mistral' else None)
+
+persist_directory = CHROMA_DIR # Chroma vector store
+vectordb = Chroma(collection_name=os.getenv("CHROMA_COLLECTION") or collection_name(EMBEDDING_BACKEND, model_name),
+                  persist_directory=persist_directory, embedding_function=embeddings)
+version_path = os.path.join(persist_directory, f'{vectordb._collection.name}.version')
+
+
+def get_version() -> int:
+    """Return the version of the movie documents, incremented on every write of the collection."""
+
+    try:
+        with open(version_path) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def bump_version():
+    """Increment the version of the movie documents, once they are written."""
+
+    temporary = f'{version_path}.{os.getpid()}'
+    with open(temporary, 'w') as f:
+        f.write(str(get_version() + 1))
+    os.replace(temporary, version_path) # readers never see a partial file
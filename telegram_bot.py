@@ -1,19 +1,122 @@
-import os, asyncio, logging
+import os, time, asyncio, logging, weakref
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters.command import Command
+from aiogram.utils.chat_action import ChatActionSender
+from langchain_core.messages import AIMessageChunk
 from telegramify_markdown import markdownify
 
 load_dotenv()
 
-from LLM.agent import app
+from LLM.agent import app, asummarize, tool_iterations, SUMMARY_MODE
+from LLM.metrics import metrics, METRICS_PORT
+from LLM.llm import timetable_snapshot, TIMETABLE_SNAPSHOT
 
 logging.basicConfig(level=logging.INFO)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+MAX_CONCURRENT_CHATS = int(os.getenv("MAX_CONCURRENT_CHATS", 8))
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0)) # seconds between edits of a streamed message
+MESSAGE_LIMIT = 4096 # characters in a Telegram message
+
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+conversation_slots = asyncio.Semaphore(MAX_CONCURRENT_CHATS) # caps conversations in flight
+chat_locks = weakref.WeakValueDictionary() # one lock per chat keeps its messages in order
+background_tasks = set()
+
+def get_chat_lock(chat_id):
+    """Return the lock serializing messages of a single chat."""
+
+    lock = chat_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        chat_locks[chat_id] = lock
+    return lock
+
+
+async def summarize_chat(chat_id, config):
+    """Update the rolling summary once the reply is sent. The chat lock is taken only to read the messages and to write
+    the summary, so the next message of the chat doesn't wait for the model call in between."""
+
+    try:
+        await asummarize(config, lock=get_chat_lock(chat_id))
+    except Exception:
+        logging.exception(f"Summary of chat {chat_id} failed")
+
+
+def safe_prefix(text):
+    """Part of a partial answer that ends on a line or word boundary, so no markup is cut in the middle."""
+
+    end = text.rfind('\n')
+    if end <= 0:
+        end = text.rfind(' ')
+    return text[:end].rstrip()[:MESSAGE_LIMIT - 96] if end > 0 else ''
+
+def split_message(text, limit=MESSAGE_LIMIT - 96):
+    """Split an answer into parts fitting in a Telegram message after escaping, at paragraph or line boundaries."""
+
+    parts = []
+    while len(text) > limit:
+        end = text.rfind('\n\n', 0, limit)
+        if end <= 0:
+            end = text.rfind('\n', 0, limit)
+        if end <= 0:
+            end = limit
+        parts.append(text[:end])
+        text = text[end:].lstrip('\n')
+    return parts + [text]
+
+@metrics.timed('telegram_send')
+async def show(message, reply, text):
+    """Send or edit the reply with the text, as MarkdownV2 or, if Telegram can't parse it, as plain text."""
+
+    for content, parse_mode in ((markdownify(text), 'MarkdownV2'), (text, None)):
+        try:
+            if reply is None:
+                return await message.answer(content, parse_mode=parse_mode)
+            await reply.edit_text(content, parse_mode=parse_mode)
+            return reply
+        except TelegramBadRequest as e:
+            if 'not modified' in str(e):
+                return reply
+            logging.warning(f"Can't show the reply as {parse_mode}: {e}")
+    return reply
+
+async def stream_answer(message, config):
+    """Run the agent and edit the reply as the tokens of its answer arrive, at most once per STREAM_EDIT_INTERVAL."""
+
+    reply, text, message_id = None, '', None
+    shown, edited_at = '', 0.0
+    async for chunk, metadata in app.astream({"messages": [("human", message.text)]}, config=config, stream_mode="messages"):
+        if metadata.get('langgraph_node') != 'agent' or not isinstance(chunk, AIMessageChunk) or not isinstance(chunk.content, str):
+            continue
+        if 'summary' in metadata.get('tags', ()): # the blocking summary, made in the agent node before the answer
+            continue
+        if chunk.id != message_id: # a new model call, e.g. after tools
+            message_id, text = chunk.id, ''
+        text += chunk.content
+        partial = safe_prefix(text)
+        if partial and partial != shown and time.monotonic() - edited_at >= STREAM_EDIT_INTERVAL:
+            try:
+                reply = await show(message, reply, partial)
+                shown, edited_at = partial, time.monotonic()
+            except TelegramRetryAfter as e: # skip edits until Telegram allows them again
+                edited_at = time.monotonic() + e.retry_after
+
+    messages = (await app.aget_state(config)).values['messages']
+    answer = messages[-1].content
+    for i, part in enumerate(split_message(answer)):
+        try:
+            reply = await show(message, reply if i == 0 else None, part)
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            reply = await show(message, reply if i == 0 else None, part)
+    return messages
+
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
@@ -23,13 +126,31 @@ async def cmd_start(message: types.Message):
 async def responder(message: types.Message):
     user_id = message.chat.id
     config = {"configurable": {"thread_id": user_id}}
-    messages = app.invoke({"messages": [("human", message.text)]}, config=config)
-    llm_answer = messages['messages'][-1].content
-    escaped_answer = markdownify(llm_answer)
-    await message.answer(escaped_answer, parse_mode='MarkdownV2')
+    async with get_chat_lock(user_id):
+        with metrics.stage('responder'):
+            async with ChatActionSender.typing(bot=bot, chat_id=user_id):
+                async with conversation_slots:
+                    if STREAM_RESPONSES:
+                        messages = await stream_answer(message, config)
+                    else:
+                        messages = (await app.ainvoke({"messages": [("human", message.text)]}, config=config))['messages']
+            if not STREAM_RESPONSES:
+                llm_answer = messages[-1].content
+                escaped_answer = markdownify(llm_answer)
+                with metrics.stage('telegram_send'):
+                    await message.answer(escaped_answer, parse_mode='MarkdownV2')
+        metrics.observe('tool_iterations', 'responder', tool_iterations(messages))
+        if SUMMARY_MODE == 'rolling':
+            task = asyncio.create_task(summarize_chat(user_id, config))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
 
 async def main():
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    if TIMETABLE_SNAPSHOT: # loaded before the first question
+        await asyncio.to_thread(timetable_snapshot.refresh)
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
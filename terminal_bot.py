@@ -1,7 +1,7 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from LLM.agent import app
+from LLM.agent import app, summarize, SUMMARY_MODE
 
 if __name__ == "__main__":
     config = {"configurable": {"thread_id": 'user_id'}}
@@ -9,4 +9,6 @@ if __name__ == "__main__":
         user_input = input("You: ").strip()
         messages = app.invoke({"messages": [("human", user_input)]}, config=config)
         llm_answer = messages['messages'][-1].content
-        print('Agent:', llm_answer)
\ No newline at end of file
+        print('Agent:', llm_answer)
+        if SUMMARY_MODE == 'rolling':
+            summarize(config)
\ No newline at end of file